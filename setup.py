@@ -39,5 +39,10 @@ setup(
     author="Samapriya Roy",
     author_email="samapriya.roy@gmail.com",
     description="Simple CLI for running internet speed tests",
-    entry_points={"console_scripts": ["speedcheck=speedcheck.speedcheck:main"]},
+    entry_points={
+        "console_scripts": [
+            "speedcheck=speedcheck.speedcheck:main",
+            "speedcheckd=speedcheck.daemon:main",
+        ]
+    },
 )
@@ -0,0 +1,190 @@
+import asyncio
+import contextvars
+import socket
+import sys
+import threading
+from typing import Optional
+
+from .deadline import Deadline
+from .netbind import BINDABLE, BindSpec, parse_bind
+from .progress import ProgressReporter
+from .providers import PROVIDERS, run_provider
+from .summary import summarize
+
+_quiet = contextvars.ContextVar("speedcheck_quiet", default=False)
+_install_lock = threading.Lock()
+
+
+class _QuietStdout:
+    """
+    Stands in for sys.stdout and drops what the providers print during an
+    API run. Only writes made in the context of the run are dropped, other
+    threads and tasks of the host process keep printing.
+    """
+
+    def __init__(self, stream) -> None:
+        self._stream = stream
+
+    def write(self, text):
+        if _quiet.get():
+            return len(text)
+        return self._stream.write(text)
+
+    def flush(self) -> None:
+        if not _quiet.get():
+            self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def _install_quiet_stdout() -> None:
+    with _install_lock:
+        if sys.stdout is not None and not isinstance(sys.stdout, _QuietStdout):
+            sys.stdout = _QuietStdout(sys.stdout)
+
+
+def _unmuted(callback):
+    # The user's own callback runs inside the run, keep what it prints
+    def call(event):
+        token = _quiet.set(False)
+        try:
+            callback(event)
+        finally:
+            _quiet.reset(token)
+
+    return call
+
+
+class Quantity:
+    __slots__ = ("value", "unit")
+
+    def __init__(self, value: float, unit: str) -> None:
+        self.value = value
+        self.unit = unit
+
+    def __float__(self) -> float:
+        return float(self.value)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Quantity):
+            return (self.value, self.unit) == (other.value, other.unit)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"Quantity({self.value!r}, {self.unit!r})"
+
+    def __str__(self) -> str:
+        return f"{self.value} {self.unit}"
+
+
+def _quantity(value: Optional[float], unit: str) -> Optional[Quantity]:
+    return None if value is None else Quantity(value, unit)
+
+
+class SpeedResult:
+    """
+    The result of one speed test. Rates are in Mbps and times in ms, and
+    a measurement the provider does not report is None. `raw` is the
+    provider's own result dict with its formatted strings.
+    """
+
+    __slots__ = (
+        "provider",
+        "download",
+        "upload",
+        "latency",
+        "jitter",
+        "server",
+        "client_cpu",
+        "cross_traffic",
+        "network",
+        "raw",
+    )
+
+    def __init__(self, provider: str, raw: dict) -> None:
+        summary = summarize(raw)
+        self.provider = provider
+        self.download = _quantity(summary["download_mbps"], "Mbps")
+        self.upload = _quantity(summary["upload_mbps"], "Mbps")
+        self.latency = _quantity(summary["latency_ms"], "ms")
+        self.jitter = _quantity(summary["jitter_ms"], "ms")
+        self.server = next(
+            (raw[key] for key in ("Server Name", "Server Location", "server_name") if raw.get(key)), None
+        )
+        self.client_cpu = raw.get("Client CPU")
+        self.cross_traffic = raw.get("Cross Traffic")
+        self.network = raw.get("Network Measured")
+        self.raw = raw
+
+    def to_dict(self) -> dict:
+        """Return the result as plain JSON ready values."""
+        data = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            data[name] = {"value": value.value, "unit": value.unit} if isinstance(value, Quantity) else value
+        return data
+
+    def __repr__(self) -> str:
+        return (
+            f"SpeedResult(provider={self.provider!r}, download={self.download}, "
+            f"upload={self.upload}, latency={self.latency}, jitter={self.jitter})"
+        )
+
+
+def run(
+    provider: str,
+    *,
+    bind=None,
+    family: int = socket.AF_UNSPEC,
+    timeout: Optional[float] = None,
+    progress=None,
+    interval: float = 0.25,
+    cross_traffic_limit: Optional[float] = None,
+    reruns: int = 0,
+    **options,
+) -> SpeedResult:
+    """
+    Run speed test `provider` in this thread and return a SpeedResult.
+
+    `bind` is a source address, an interface name or a BindSpec, `family`
+    forces socket.AF_INET or AF_INET6 and `timeout` is the overall deadline
+    in seconds. `progress` is called with every ProgressEvent. Other
+    `options` go to the provider, for example `streams` for ookla-native.
+    Failures raise SpeedcheckError, invalid arguments ValueError.
+    """
+    if provider not in PROVIDERS:
+        raise ValueError(f"Invalid speedtest type: {provider}")
+    if isinstance(bind, BindSpec):
+        specs = [bind]
+    elif bind is not None or family != socket.AF_UNSPEC:
+        specs = [parse_bind(bind, family)]
+    else:
+        specs = []
+    if specs and provider not in BINDABLE:
+        raise ValueError(f"Source binding is only supported for: {', '.join(BINDABLE)}")
+    deadline = Deadline(timeout)
+
+    def reporter(spec=None):
+        callbacks = [_unmuted(progress)] if progress else []
+        return ProgressReporter(provider, *callbacks, interval=interval)
+
+    _install_quiet_stdout()
+    token = _quiet.set(True)
+    try:
+        with deadline.guard(provider):
+            results = run_provider(
+                provider, specs, False, deadline, reporter, cross_traffic_limit, reruns, **options
+            )
+    finally:
+        _quiet.reset(token)
+    return SpeedResult(provider, results[0])
+
+
+async def arun(provider: str, **options) -> SpeedResult:
+    """
+    Async version of `run`. The test runs in a worker thread, so the event
+    loop stays free. Cancelling the await does not stop a running test,
+    pass `timeout` to bound it.
+    """
+    return await asyncio.to_thread(run, provider, **options)
@@ -0,0 +1,121 @@
+import contextlib
+import hashlib
+import json
+import os
+import time
+
+from .deadline import Deadline, DeadlineExceeded
+
+# Seconds between attempts to take a lock held by another process
+LOCK_POLL = 0.1
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+
+def cache_dir():
+    """
+    Return the directory used for cached results and lock files.
+    """
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    path = os.path.join(base, "speedcheck")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+@contextlib.contextmanager
+def file_lock(path, deadline=None):
+    """
+    Hold an exclusive lock on `path` across processes, waiting until it is
+    free or `deadline` runs out, which raises DeadlineExceeded.
+    """
+    deadline = deadline or Deadline()
+    with open(path, "a+") as handle:
+        while True:
+            try:
+                if os.name == "nt":
+                    handle.seek(0)
+                    msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+                else:
+                    fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                remaining = deadline.remaining()
+                if remaining is not None and remaining <= 0:
+                    raise DeadlineExceeded("Timed out waiting for a concurrent run to finish") from None
+                time.sleep(LOCK_POLL if remaining is None else min(LOCK_POLL, remaining))
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                handle.seek(0)
+                msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
+
+def cache_key(provider, *parts):
+    """
+    Return the cache key for `provider` run with the options in `parts`.
+    """
+    options = [str(part) for part in parts if part]
+    if not options:
+        return provider
+    digest = hashlib.sha1("|".join(options).encode()).hexdigest()[:12]
+    return f"{provider}-{digest}"
+
+
+def read_cached(key, max_age=None, since=None):
+    """
+    Return the cached entry for `key` if it is at most `max_age` seconds old
+    or was stored after the `since` timestamp, otherwise None.
+    """
+    try:
+        with open(os.path.join(cache_dir(), f"{key}.json"), encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if since is not None and entry["time"] >= since:
+        return entry
+    if max_age is not None and time.time() - entry["time"] <= max_age:
+        return entry
+    return None
+
+
+def write_cached(key, result):
+    path = os.path.join(cache_dir(), f"{key}.json")
+    entry = {"time": time.time(), "result": result}
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(entry, f)
+    # Readers never see a half written file
+    os.replace(tmp, path)
+    return entry
+
+
+def single_flight(key, max_age, measure, deadline=None):
+    """
+    Return (result, cached). A result cached within `max_age` seconds is
+    returned as is. Otherwise the first process to take the lock for `key`
+    calls `measure()` and stores its result, while concurrent callers wait
+    on the lock, for at most the time left on `deadline`, and then share
+    that result instead of measuring themselves.
+    """
+    entry = read_cached(key, max_age)
+    if entry:
+        return entry["result"], True
+
+    requested = time.time()
+    with file_lock(os.path.join(cache_dir(), f"{key}.lock"), deadline):
+        entry = read_cached(key, max_age, since=requested)
+        if entry:
+            return entry["result"], True
+        result = measure()
+        if result is not None:
+            write_cached(key, result)
+        return result, False
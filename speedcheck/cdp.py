@@ -0,0 +1,154 @@
+from typing import Optional
+
+# Width of the bins of the byte series
+SERIES_INTERVAL = 0.5
+# Bins moving less than this share of the busiest bin are ramp up, page
+# assets or idle time and do not count towards the measured rate
+ACTIVE_SHARE = 0.1
+
+
+class NetworkMeter:
+    """
+    Counts the bytes a Chromium page moves from Chrome DevTools Protocol
+    network events, independently of the numbers the speed test site shows.
+
+    Received bytes come from Network.dataReceived as they arrive and are
+    reconciled with the wire size in Network.loadingFinished. Sent bytes
+    are the request bodies, taken from the Content-Length in
+    Network.requestWillBeSentExtraInfo, spread evenly from the moment the
+    request was sent until its response arrived. Uploads cancelled before
+    a response are not counted, the share of them that was sent is unknown.
+    """
+
+    def __init__(self, interval: float = SERIES_INTERVAL) -> None:
+        self.interval = interval
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.progress = None
+        self._progress_base = 0
+        self._received = []
+        self._per_request = {}
+        self._requests = {}
+        self._content_length = {}
+        self._sent = []
+
+    @property
+    def handlers(self) -> dict:
+        return {
+            "Network.dataReceived": self._on_data,
+            "Network.loadingFinished": self._on_finished,
+            "Network.requestWillBeSent": self._on_request,
+            "Network.requestWillBeSentExtraInfo": self._on_request_headers,
+            "Network.responseReceived": self._on_response,
+        }
+
+    def attach(self, session):
+        """
+        Subscribe to the network events of a CDPSession from the sync or
+        async Playwright API. Returns what `session.send` returns, so async
+        callers await it.
+        """
+        for event, handler in self.handlers.items():
+            session.on(event, handler)
+        # Upload bodies are not needed, only their size
+        return session.send("Network.enable", {"maxPostDataSize": 0})
+
+    def follow(self, progress) -> None:
+        """
+        Report the bytes moved from now on to `progress`, for sites whose
+        page does not show how much was transferred. None stops reporting.
+        """
+        self.progress = progress
+        self._progress_base = self.bytes_received + self.bytes_sent
+
+    def _report_progress(self) -> None:
+        if self.progress:
+            self.progress.update(self.bytes_received + self.bytes_sent - self._progress_base)
+
+    def _add_received(self, timestamp, nbytes) -> None:
+        self._received.append((timestamp, nbytes))
+        self.bytes_received += nbytes
+        self._report_progress()
+
+    def _on_data(self, params) -> None:
+        # encodedDataLength is often only reported in loadingFinished, speed
+        # test payloads are not compressed so dataLength is the wire size
+        nbytes = params.get("encodedDataLength") or params.get("dataLength", 0)
+        request_id = params["requestId"]
+        self._per_request[request_id] = self._per_request.get(request_id, 0) + nbytes
+        self._add_received(params["timestamp"], nbytes)
+
+    def _on_finished(self, params) -> None:
+        remainder = params.get("encodedDataLength", 0) - self._per_request.pop(params["requestId"], 0)
+        if remainder > 0:
+            self._add_received(params["timestamp"], remainder)
+
+    def _on_request(self, params) -> None:
+        request = params.get("request", {})
+        size = len(request["postData"].encode()) if request.get("postData") else 0
+        self._requests[params["requestId"]] = (params["timestamp"], size)
+
+    def _on_request_headers(self, params) -> None:
+        for name, value in params.get("headers", {}).items():
+            if name.lower() == "content-length" and value.isdigit():
+                self._content_length[params["requestId"]] = int(value)
+
+    def _on_response(self, params) -> None:
+        request_id = params["requestId"]
+        if request_id not in self._requests:
+            return
+        start, size = self._requests.pop(request_id)
+        size = max(size, self._content_length.pop(request_id, 0))
+        if size:
+            self._sent.append((start, params["timestamp"], size))
+            self.bytes_sent += size
+            self._report_progress()
+
+    def _rate(self, bins: list) -> Optional[float]:
+        peak = max(bins, default=0)
+        active = [nbytes for nbytes in bins if peak and nbytes >= peak * ACTIVE_SHARE]
+        if not active:
+            return None
+        return round(sum(active) * 8 / 1_000_000 / (len(active) * self.interval), 2)
+
+    def report(self) -> Optional[dict]:
+        """
+        Return the download and upload rates measured on the network, the
+        byte totals and a series of [seconds, download Mbps, upload Mbps]
+        per SERIES_INTERVAL, or None if no network events were seen.
+        """
+        spans = list(self._sent)
+        times = [t for t, _ in self._received] + [t for span in spans for t in span[:2]]
+        if not times:
+            return None
+        origin = min(times)
+        count = int((max(times) - origin) / self.interval) + 1
+        received = [0.0] * count
+        sent = [0.0] * count
+        for timestamp, nbytes in self._received:
+            received[int((timestamp - origin) / self.interval)] += nbytes
+        for start, end, nbytes in spans:
+            first = int((start - origin) / self.interval)
+            last = int((end - origin) / self.interval)
+            if end <= start:
+                sent[last] += nbytes
+                continue
+            for index in range(first, last + 1):
+                lower = max(start, origin + index * self.interval)
+                upper = min(end, origin + (index + 1) * self.interval)
+                sent[index] += nbytes * max(0.0, upper - lower) / (end - start)
+
+        def mbps(nbytes):
+            return round(nbytes * 8 / 1_000_000 / self.interval, 2)
+
+        return {
+            "download_mbps": self._rate(received),
+            "upload_mbps": self._rate(sent),
+            "bytes_received": self.bytes_received,
+            "bytes_sent": self.bytes_sent,
+            "interval_s": self.interval,
+            "series": [
+                [round(index * self.interval, 2), mbps(down), mbps(up)]
+                for index, (down, up) in enumerate(zip(received, sent))
+            ],
+        }
@@ -0,0 +1,138 @@
+import json
+import math
+import os
+import time
+from typing import NamedTuple
+
+from .cache import cache_dir, cache_key, file_lock
+from .summary import summarize
+
+# EWMA weight of a new result in the baseline mean and variance
+ALPHA = 0.1
+# Results needed before a baseline is trusted
+WARMUP = 5
+# CUSUM slack and decision threshold, in baseline standard deviations
+DRIFT = 0.5
+THRESHOLD = 5.0
+# Lower bound of the baseline standard deviation relative to its mean, so a
+# very steady link does not alert on a shift of a few percent
+MIN_RELATIVE_SD = 0.05
+# Direction in which each metric gets worse
+WORSE = {"download_mbps": "down", "upload_mbps": "down", "latency_ms": "up", "jitter_ms": "up"}
+
+
+class Alert(NamedTuple):
+    time: float
+    provider: str
+    metric: str
+    direction: str
+    degraded: bool
+    value: float
+    baseline: float
+    baseline_sd: float
+    score: float
+
+
+def new_state() -> dict:
+    return {"n": 0, "mean": 0.0, "var": 0.0, "pos": 0.0, "neg": 0.0}
+
+
+def update(state: dict, value: float):
+    """
+    Feed one value into the rolling state of a metric, in place and in
+    constant time. Returns (direction, score, baseline, baseline_sd) when
+    a two-sided CUSUM on the value standardised against the EWMA baseline
+    detects a shift, after which the baseline restarts at the new level.
+    """
+    n = state["n"] + 1
+    mean, var = state["mean"], state["var"]
+    if n > WARMUP:
+        sd = max(math.sqrt(var), abs(mean) * MIN_RELATIVE_SD, 1e-9)
+        z = (value - mean) / sd
+        state["pos"] = max(0.0, state["pos"] + z - DRIFT)
+        state["neg"] = max(0.0, state["neg"] - z - DRIFT)
+        if state["pos"] > THRESHOLD or state["neg"] > THRESHOLD:
+            direction = "up" if state["pos"] > THRESHOLD else "down"
+            score = max(state["pos"], state["neg"])
+            state.update(n=1, mean=value, pos=0.0, neg=0.0)
+            return direction, score, mean, sd
+    # Plain running average while warming up, EWMA after that
+    alpha = max(ALPHA, 1 / n)
+    delta = value - mean
+    state.update(n=n, mean=mean + alpha * delta, var=(1 - alpha) * (var + alpha * delta * delta))
+    return None
+
+
+def _state_path(key: str) -> str:
+    return os.path.join(cache_dir(), f"{key}.changepoint.json")
+
+
+def detect(name: str, key: str, result: dict) -> list:
+    """
+    Update the state stored under `key` with the download, upload, latency
+    and jitter of `result` and return an Alert for every metric that
+    shifted. The state is a few numbers per metric, kept next to the cached
+    results and updated under a lock, so concurrent runs do not lose updates.
+    """
+    path = _state_path(key)
+    alerts = []
+    with file_lock(f"{path}.lock"):
+        try:
+            with open(path, encoding="utf-8") as f:
+                states = json.load(f)
+        except (OSError, ValueError):
+            states = {}
+        for metric, value in summarize(result).items():
+            if value is None:
+                continue
+            shift = update(states.setdefault(metric, new_state()), value)
+            if shift:
+                direction, score, baseline, sd = shift
+                alerts.append(Alert(
+                    time=time.time(),
+                    provider=name,
+                    metric=metric,
+                    direction=direction,
+                    degraded=direction == WORSE[metric],
+                    value=value,
+                    baseline=round(baseline, 3),
+                    baseline_sd=round(sd, 3),
+                    score=round(score, 2),
+                ))
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(states, f)
+        os.replace(tmp, path)
+    return alerts
+
+
+def _usable(result) -> bool:
+    # Results flagged for cross-traffic would read as shifts of the link
+    return (
+        isinstance(result, dict)
+        and "Error" not in result
+        and not (result.get("Cross Traffic") or {}).get("contaminated")
+    )
+
+
+def check(provider: str, results: list, specs=(), multi=False) -> list:
+    """
+    Run `detect` on the results of one speedcheck run, keeping a separate
+    history for every link. Links of a --multi run share their history with
+    runs bound to the same link on its own.
+    """
+    alerts = []
+    if multi:
+        for spec in specs:
+            link = results[0]["Links"].get(spec.label)
+            if _usable(link):
+                alerts += detect(f"{provider}@{spec.label}", cache_key(provider, spec.label), link)
+        return alerts
+    for spec, result in zip(specs or [None], results):
+        if not _usable(result):
+            continue
+        if spec is None:
+            alerts += detect(provider, provider, result)
+        else:
+            alerts += detect(f"{provider}@{spec.label}", cache_key(provider, spec.label), result)
+    return alerts
@@ -0,0 +1,187 @@
+import os
+import threading
+import time
+from typing import NamedTuple, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SAMPLE_INTERVAL = 0.25
+# Share of a core above which it counts as saturated, and share of the
+# sample intervals of a phase that must be saturated to flag the run
+SATURATED = 0.9
+SATURATED_SHARE = 0.5
+PROC_STAT = "/proc/stat"
+
+
+class CpuSample(NamedTuple):
+    time: float
+    user: float
+    system: float
+    # (busy, total) jiffies per core, empty where /proc/stat is missing
+    cores: tuple
+
+
+def _process_times() -> tuple[float, float]:
+    if resource is None:
+        times = os.times()
+        return times.user, times.system
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime, usage.ru_stime
+
+
+def _core_times() -> tuple:
+    try:
+        with open(PROC_STAT) as stat:
+            lines = stat.readlines()
+    except OSError:
+        return ()
+    cores = []
+    for line in lines:
+        if line.startswith("cpu") and line[3].isdigit():
+            # user nice system idle iowait irq softirq steal, guest time is
+            # already part of user
+            fields = [int(value) for value in line.split()[1:9]]
+            total = sum(fields)
+            cores.append((total - fields[3] - fields[4], total))
+    return tuple(cores)
+
+
+def sample() -> CpuSample:
+    user, system = _process_times()
+    return CpuSample(time.time(), user, system, _core_times())
+
+
+def _busiest_core(first: CpuSample, last: CpuSample) -> Optional[float]:
+    busiest = None
+    for (busy0, total0), (busy1, total1) in zip(first.cores, last.cores):
+        if total1 > total0:
+            busiest = max(busiest or 0.0, (busy1 - busy0) / (total1 - total0))
+    return busiest
+
+
+def _process_cores(first: CpuSample, last: CpuSample) -> Optional[float]:
+    wall = last.time - first.time
+    if wall <= 0:
+        return None
+    return (last.user + last.system - first.user - first.system) / wall
+
+
+def phase_stats(samples: list, nbytes: int, system_wide: bool = False) -> dict:
+    """
+    Summarise the CpuSamples taken during one phase in which `nbytes` were
+    moved. A sample interval is saturated when the process used a whole
+    core (Python rarely gets further because of the GIL). With
+    `system_wide`, for engines that run in a browser's renderer process,
+    it is saturated when any single core of the machine was busy instead.
+    """
+    first, last = samples[0], samples[-1]
+    user = last.user - first.user
+    system = last.system - first.system
+    cpu = user + system
+    intervals = list(zip(samples, samples[1:]))
+    saturated = sum(
+        1
+        for a, b in intervals
+        if (_process_cores(a, b) or 0) >= SATURATED
+        or (system_wide and (_busiest_core(a, b) or 0) >= SATURATED)
+    )
+    process_cores = _process_cores(first, last)
+    busiest_core = _busiest_core(first, last)
+    return {
+        "seconds": round(last.time - first.time, 3),
+        "bytes": nbytes,
+        "user_s": round(user, 3),
+        "system_s": round(system, 3),
+        "cpu_s_per_gb": round(cpu / (nbytes / 1e9), 3) if nbytes else None,
+        "process_cores": round(process_cores, 2) if process_cores is not None else None,
+        "busiest_core": round(busiest_core, 2) if busiest_core is not None else None,
+        "saturated_share": round(saturated / len(intervals), 2) if intervals else 0.0,
+    }
+
+
+class CpuMonitor:
+    """
+    Samples the process CPU time (getrusage) and the load of every core
+    (/proc/stat) in a background thread while a measurement runs.
+
+    The monitor is a progress callback: added to the run's ProgressReporter
+    it learns when each phase starts and ends and how many bytes it moved.
+    Several reporters running at the same time, as with --multi, can share
+    one monitor, their phases of the same name are merged.
+
+    `system_wide` also counts a busy core used by another process as
+    saturation, for providers that measure in a browser.
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL, system_wide: bool = False) -> None:
+        self.interval = interval
+        self.system_wide = system_wide
+        self.samples = []
+        self._phases = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __call__(self, event) -> None:
+        with self._lock:
+            entry = self._phases.setdefault(event.phase, [event.time, event.time, {}])
+            entry[1] = event.time
+            entry[2][event.provider] = event.bytes
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.samples.append(sample())
+
+    def start(self) -> "CpuMonitor":
+        self.samples.append(sample())
+        self._thread = threading.Thread(target=self._run, name="speedcheck-cpumon", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.samples.append(sample())
+
+    def __enter__(self) -> "CpuMonitor":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def _window(self, start: float, end: float) -> list:
+        # From the last sample before the phase to the first one after it
+        first = max((i for i, s in enumerate(self.samples) if s.time <= start), default=0)
+        last = next((i for i, s in enumerate(self.samples) if s.time >= end), len(self.samples) - 1)
+        return self.samples[first:last + 1]
+
+    def report(self) -> dict:
+        """
+        Return the CPU use per phase, the CPU seconds per GB over all
+        transfer phases and whether the client was the bottleneck.
+        """
+        with self._lock:
+            phases = list(self._phases.items())
+        stats = {}
+        cpu = moved = 0.0
+        for name, (start, end, nbytes) in phases:
+            window = self._window(start, end)
+            if len(window) < 2:
+                continue
+            stats[name] = phase_stats(window, sum(nbytes.values()), self.system_wide)
+            if stats[name]["bytes"]:
+                cpu += stats[name]["user_s"] + stats[name]["system_s"]
+                moved += stats[name]["bytes"]
+        return {
+            "client_bound": any(
+                phase["saturated_share"] >= SATURATED_SHARE
+                for name, phase in stats.items()
+                if name != "latency"
+            ),
+            "cpu_s_per_gb": round(cpu / (moved / 1e9), 3) if moved else None,
+            "cores": os.cpu_count(),
+            "phases": stats,
+        }
@@ -0,0 +1,170 @@
+import ipaddress
+import socket
+import struct
+import threading
+from typing import NamedTuple, Optional
+
+PROC_NET_DEV = "/proc/net/dev"
+PROC_NET_ROUTE = "/proc/net/route"
+PROC_NET_IPV6_ROUTE = "/proc/net/ipv6_route"
+PROC_NET_IF_INET6 = "/proc/net/if_inet6"
+SIOCGIFADDR = 0x8915
+
+# Share of the interface bytes in the direction of a phase that may come
+# from other traffic before the result is flagged as contaminated
+CROSS_TRAFFIC_LIMIT = 0.1
+# TCP/IP and TLS framing the engines do not see, about 40-80 bytes per
+# 1448 byte segment
+PROTOCOL_OVERHEAD = 0.05
+
+
+class Counters(NamedTuple):
+    rx_bytes: int
+    tx_bytes: int
+
+
+def read_counters(interface: str) -> Optional[Counters]:
+    """
+    Return the receive and transmit byte counters of `interface`.
+    """
+    try:
+        with open(PROC_NET_DEV) as dev:
+            lines = dev.readlines()[2:]
+    except OSError:
+        return None
+    for line in lines:
+        name, _, data = line.partition(":")
+        if name.strip() == interface:
+            fields = data.split()
+            return Counters(int(fields[0]), int(fields[8]))
+    return None
+
+
+def _read_table(path: str) -> list:
+    try:
+        with open(path) as table:
+            return [line.split() for line in table]
+    except OSError:
+        return []
+
+
+def _default_route(family: int) -> Optional[str]:
+    if family == socket.AF_INET6:
+        # dest prefix_len src src_len next_hop metric refcnt use flags iface
+        routes = [
+            (int(row[5], 16), row[9])
+            for row in _read_table(PROC_NET_IPV6_ROUTE)
+            if len(row) >= 10 and int(row[0], 16) == 0 and row[1] == "00" and row[9] != "lo"
+        ]
+    else:
+        # Iface Destination Gateway Flags RefCnt Use Metric Mask ...
+        routes = [
+            (int(row[6]), row[0])
+            for row in _read_table(PROC_NET_ROUTE)[1:]
+            if len(row) >= 8 and row[1] == "00000000" and row[7] == "00000000"
+        ]
+    return min(routes)[1] if routes else None
+
+
+def _interface_for_address(address: str) -> Optional[str]:
+    ip = ipaddress.ip_address(address)
+    if ip.version == 6:
+        for row in _read_table(PROC_NET_IF_INET6):
+            if len(row) >= 6 and ipaddress.IPv6Address(int(row[0], 16)) == ip:
+                return row[5]
+        return None
+    try:
+        import fcntl
+    except ImportError:
+        return None
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for _, name in socket.if_nameindex():
+            try:
+                reply = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, struct.pack("256s", name.encode()[:15]))
+            except OSError:
+                continue
+            if socket.inet_ntoa(reply[20:24]) == address:
+                return name
+    return None
+
+
+def egress_interface(spec=None) -> Optional[str]:
+    """
+    Return the interface a run leaves through: the bound interface, the one
+    holding the bound address, or the one with the default route. None where
+    it cannot be told, which disables the cross-traffic check.
+    """
+    if spec is not None and spec.interface:
+        return spec.interface
+    if spec is not None and spec.address:
+        return _interface_for_address(spec.address)
+    family = spec.family if spec is not None else socket.AF_UNSPEC
+    return _default_route(family) or (None if family == socket.AF_INET else _default_route(socket.AF_INET6))
+
+
+class TrafficMonitor:
+    """
+    Reads the byte counters of the egress interface when each phase of a
+    run starts and ends and compares them with the bytes the engine moved.
+
+    Like CpuMonitor it is a progress callback, and it only reads the
+    counters on phase start and done events, never in the transfer loop.
+    The counters include every process on this host, but not other hosts
+    on the same link unless this host routes their traffic.
+    """
+
+    def __init__(self, interface: Optional[str], limit: float = CROSS_TRAFFIC_LIMIT) -> None:
+        self.interface = interface
+        self.limit = limit
+        self._phases = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event) -> None:
+        if self.interface is None or event.phase in ("latency", None):
+            return
+        with self._lock:
+            if event.phase not in self._phases:
+                self._phases[event.phase] = [read_counters(self.interface), None, 0]
+            if event.done:
+                entry = self._phases[event.phase]
+                entry[1] = read_counters(self.interface)
+                entry[2] = event.bytes
+
+    def report(self) -> Optional[dict]:
+        """
+        Return the cross-traffic per phase and whether any phase is over
+        the limit, or None when the interface counters are unavailable.
+        """
+        if self.interface is None:
+            return None
+        phases = {}
+        with self._lock:
+            items = list(self._phases.items())
+        for name, (start, end, engine_bytes) in items:
+            if start is None or end is None or not engine_bytes:
+                continue
+            rx = end.rx_bytes - start.rx_bytes
+            tx = end.tx_bytes - start.tx_bytes
+            # Browser providers only report one phase for both directions
+            if name == "upload":
+                interface_bytes, reverse_bytes = tx, rx
+            elif name == "download":
+                interface_bytes, reverse_bytes = rx, tx
+            else:
+                interface_bytes, reverse_bytes = rx + tx, 0
+            cross = max(0, interface_bytes - int(engine_bytes * (1 + PROTOCOL_OVERHEAD)))
+            phases[name] = {
+                "engine_bytes": engine_bytes,
+                "interface_bytes": interface_bytes,
+                "cross_bytes": cross,
+                "cross_share": round(cross / interface_bytes, 3) if interface_bytes else 0.0,
+                "reverse_bytes": reverse_bytes,
+            }
+        worst = max((phase["cross_share"] for phase in phases.values()), default=0.0)
+        return {
+            "interface": self.interface,
+            "cross_share": worst,
+            "contaminated": worst > self.limit,
+            "limit": self.limit,
+            "phases": phases,
+        }
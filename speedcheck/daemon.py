@@ -0,0 +1,384 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import cache_dir
+from .deadline import Deadline, DeadlineExceeded, SpeedcheckError, classify
+from .netbind import BINDABLE, parse_bind
+from .progress import ProgressReporter
+from .providers import PROVIDERS, get_runner, run_provider
+
+log = logging.getLogger("speedcheckd")
+
+# Providers whose entry point calls asyncio.run, which cannot share a thread
+# with the running loop of the sync Playwright instance the other browser
+# providers reuse
+ASYNC_PROVIDERS = ("fast", "mlab", "ookla-native")
+WARM_BROWSER_PROVIDERS = ("openspeedtest", "speedsmart")
+# Number of recent runs kept for the status report
+RECENT_RUNS = 20
+# Seconds past a run's timeout a client waits for speedcheckd to report it
+REPLY_GRACE = 5
+
+
+def _field(req, key, kinds, default=None):
+    value = req.get(key)
+    if value is None:
+        return default
+    # bool is an int subclass, but only valid where it is asked for
+    if not isinstance(value, kinds) or isinstance(value, bool) and bool not in kinds:
+        raise SpeedcheckError("bad_request", f"Invalid {key}: {value!r}")
+    return value
+
+
+def socket_path():
+    """
+    Return the Unix socket speedcheckd listens on. SPEEDCHECK_SOCKET
+    overrides the default in XDG_RUNTIME_DIR or the cache directory.
+    """
+    if os.environ.get("SPEEDCHECK_SOCKET"):
+        return os.environ["SPEEDCHECK_SOCKET"]
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], "speedcheck.sock")
+    return os.path.join(cache_dir(), "speedcheckd.sock")
+
+
+def _connect(path=None, timeout=None):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path or socket_path())
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def available(path=None):
+    """
+    Return True when a speedcheckd is accepting connections.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        return False
+    path = path or socket_path()
+    if not os.path.exists(path):
+        return False
+    try:
+        _connect(path, timeout=1).close()
+    except OSError:
+        return False
+    return True
+
+
+def request(payload, on_event=None, path=None, timeout=None):
+    """
+    Send one request to speedcheckd and return its final reply. Progress
+    events received before the reply are passed to `on_event`. With a
+    `timeout` in seconds, waiting longer for the reply raises
+    DeadlineExceeded.
+    """
+    deadline = Deadline(timeout)
+    with _connect(path, deadline.remaining()) as sock:
+        sock.sendall((json.dumps(payload) + "\n").encode())
+        with sock.makefile("r", encoding="utf-8") as lines:
+            while True:
+                try:
+                    # A timeout of 0 would make the socket non-blocking
+                    remaining = deadline.remaining()
+                    if remaining == 0:
+                        raise socket.timeout
+                    sock.settimeout(remaining)
+                    line = lines.readline()
+                except socket.timeout:
+                    raise DeadlineExceeded(f"speedcheckd did not reply within {timeout:g} seconds") from None
+                if not line:
+                    break
+                event = json.loads(line)
+                if event.get("event") == "progress":
+                    if on_event:
+                        on_event(event)
+                    continue
+                return event
+    raise SpeedcheckError("connection_failed", "speedcheckd closed the connection without a reply")
+
+
+def run_remote(speedtest, binds=None, family=socket.AF_UNSPEC, multi=False, timeout=None, on_event=None, interval=0.25, path=None, cross_traffic_limit=None, reruns=0, streams=None):
+    """
+    Ask speedcheckd to run `speedtest` and return its reply, which holds the
+    list of results and the run's timing.
+    """
+    reply = request(
+        {
+            "op": "run",
+            "type": speedtest,
+            "bind": binds or [],
+            "family": int(family),
+            "multi": multi,
+            "timeout": timeout,
+            "progress": on_event is not None,
+            "interval": interval,
+            "cross_traffic_limit": cross_traffic_limit,
+            "reruns": reruns,
+            "streams": streams,
+        },
+        on_event,
+        path,
+        # The daemon enforces the timeout itself, leave it time to report it
+        timeout + REPLY_GRACE if timeout is not None else None,
+    )
+    if reply.get("event") == "error":
+        raise SpeedcheckError(**reply["error"])
+    return reply
+
+
+class Daemon:
+    """
+    Keeps the provider modules imported, a Cloudflare session with an open
+    connection and a launched Chromium around between runs. Runs are
+    serialised, since overlapping measurements would share the link.
+    """
+
+    def __init__(self, path, browser=True):
+        self.path = path
+        self.use_browser = browser
+        self.sync_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="speedcheckd-sync")
+        self.async_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="speedcheckd-async")
+        self.warm = {}
+        self.cold_start = {}
+        self.runs = []
+        self.started = time.time()
+        self._playwright = None
+        self._browser = None
+        self._session = None
+
+    def _timed(self, names, start):
+        elapsed = time.perf_counter() - start
+        for name in names:
+            self.cold_start[name] = self.cold_start.get(name, 0.0) + elapsed
+
+    def preload(self):
+        # Runs on the sync worker, Playwright objects must stay on the
+        # thread that created them
+        for name in PROVIDERS:
+            start = time.perf_counter()
+            try:
+                get_runner(name)
+            except ImportError as error:
+                log.warning("%s is unavailable: %s", name, error)
+                continue
+            self._timed([name], start)
+
+        import requests
+
+        start = time.perf_counter()
+        self._session = requests.Session()
+        try:
+            self._session.get("https://speed.cloudflare.com/__down?bytes=0", timeout=(5, 10))
+        except requests.RequestException as error:
+            log.warning("Could not open a Cloudflare connection: %s", error)
+        self.warm["cloudflare"] = {"session": self._session}
+        self._timed(["cloudflare"], start)
+
+        if not self.use_browser:
+            return
+        start = time.perf_counter()
+        try:
+            from playwright.sync_api import sync_playwright
+
+            self._playwright = sync_playwright().start()
+            self._browser = self._playwright.chromium.launch(headless=True)
+        except Exception as error:
+            log.warning("Could not launch Chromium, browser providers start cold: %s", error)
+            return
+        for name in WARM_BROWSER_PROVIDERS:
+            self.warm[name] = {"browser": self._browser}
+        self._timed(WARM_BROWSER_PROVIDERS, start)
+
+    def release(self):
+        if self._browser is not None:
+            self._browser.close()
+        if self._playwright is not None:
+            self._playwright.stop()
+        if self._session is not None:
+            self._session.close()
+
+    def status(self):
+        return {
+            "event": "status",
+            "pid": os.getpid(),
+            "uptime_s": round(time.time() - self.started, 1),
+            "warm": sorted(self.warm),
+            "cold_start_s": {name: round(value, 3) for name, value in self.cold_start.items()},
+            "recent_runs": self.runs,
+        }
+
+    def _measure(self, name, specs, multi, deadline, progress_factory, cross_traffic_limit, reruns, options):
+        with deadline.guard(name):
+            return run_provider(
+                name, specs, multi, deadline, progress_factory, cross_traffic_limit, reruns, **options
+            )
+
+    async def run(self, req, writer):
+        received = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        name = req.get("type")
+        if name not in PROVIDERS:
+            raise SpeedcheckError("bad_request", f"Invalid speedtest type: {name}")
+        binds = _field(req, "bind", (list,), [])
+        family = _field(req, "family", (int,), socket.AF_UNSPEC)
+        multi = _field(req, "multi", (bool,), False)
+        timeout = _field(req, "timeout", (int, float))
+        interval = _field(req, "interval", (int, float), 0.25)
+        cross_traffic_limit = _field(req, "cross_traffic_limit", (int, float))
+        reruns = _field(req, "reruns", (int,), 0)
+        streams = _field(req, "streams", (int,))
+        if not all(isinstance(value, str) for value in binds):
+            raise SpeedcheckError("bad_request", f"Invalid bind: {binds!r}", provider=name)
+        if family not in (socket.AF_UNSPEC, socket.AF_INET, socket.AF_INET6):
+            raise SpeedcheckError("bad_request", f"Invalid family: {family}", provider=name)
+        if interval <= 0:
+            raise SpeedcheckError("bad_request", f"Invalid interval: {interval}", provider=name)
+        if reruns < 0:
+            raise SpeedcheckError("bad_request", f"Invalid reruns: {reruns}", provider=name)
+        if streams is not None and (name != "ookla-native" or streams < 1):
+            raise SpeedcheckError("bad_request", f"Invalid streams: {streams}", provider=name)
+        try:
+            specs = [parse_bind(value, family) for value in binds]
+        except ValueError as error:
+            raise SpeedcheckError("bad_request", str(error), provider=name) from None
+        if not specs and family:
+            specs = [parse_bind(None, family)]
+        if specs and name not in BINDABLE:
+            raise SpeedcheckError("bad_request", f"Source binding is only supported for: {', '.join(BINDABLE)}", provider=name)
+        if multi and len(specs) < 2:
+            raise SpeedcheckError("bad_request", "multi needs at least two bind links", provider=name)
+        deadline = Deadline(timeout)
+        first_event = []
+
+        def on_event(event):
+            if not first_event:
+                first_event.append(time.perf_counter())
+            if req.get("progress"):
+                line = json.dumps({"event": "progress", **event._asdict()}) + "\n"
+                loop.call_soon_threadsafe(writer.write, line.encode())
+
+        def progress_factory(spec=None):
+            label = f"{name}@{spec.label}" if spec and len(specs) > 1 else name
+            return ProgressReporter(label, on_event, interval=interval)
+
+        # Warm sessions are only shared by unbound runs, binding mounts its own adapter
+        warm = {} if specs else self.warm.get(name, {})
+        options = dict(warm, streams=streams) if streams else warm
+        worker = self.async_worker if name in ASYNC_PROVIDERS else self.sync_worker
+        try:
+            await asyncio.wait_for(self.lock.acquire(), deadline.remaining())
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded("Timed out waiting for the run ahead in the queue", provider=name) from None
+        try:
+            queued = time.perf_counter() - received
+            results = await loop.run_in_executor(
+                worker, self._measure, name, specs, multi, deadline, progress_factory,
+                cross_traffic_limit, reruns, options,
+            )
+        finally:
+            self.lock.release()
+        timing = {
+            "queued_s": round(queued, 3),
+            "start_latency_s": round(first_event[0] - received - queued, 3) if first_event else None,
+            "total_s": round(time.perf_counter() - received, 3),
+        }
+        self.runs = (self.runs + [{"provider": name, "warm": bool(warm), **timing}])[-RECENT_RUNS:]
+        return {"event": "result", "provider": name, "results": results, "timing": timing}
+
+    async def handle(self, reader, writer):
+        try:
+            req = json.loads(await reader.readline())
+            if not isinstance(req, dict):
+                raise SpeedcheckError("bad_request", "Request must be a JSON object")
+            op = req.get("op")
+            if op == "ping":
+                reply = {"event": "pong", "pid": os.getpid()}
+            elif op == "status":
+                reply = self.status()
+            elif op == "run":
+                reply = await self.run(req, writer)
+            else:
+                raise SpeedcheckError("bad_request", f"Unknown op: {op}")
+        except SpeedcheckError as error:
+            reply = {"event": "error", "error": error.to_dict()}
+        except ValueError as error:
+            reply = {"event": "error", "error": SpeedcheckError("bad_request", str(error)).to_dict()}
+        except Exception as error:
+            # Still answer, a client waiting for a reply must not just see the socket close
+            log.exception("Request failed")
+            reply = {"event": "error", "error": SpeedcheckError(classify(error), str(error) or type(error).__name__).to_dict()}
+        try:
+            writer.write((json.dumps(reply) + "\n").encode())
+            await writer.drain()
+        except ConnectionError:
+            log.info("Client went away before the reply")
+        finally:
+            writer.close()
+
+    async def serve(self):
+        self.lock = asyncio.Lock()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.sync_worker, self.preload)
+        server = await asyncio.start_unix_server(self.handle, path=self.path)
+        os.chmod(self.path, 0o600)
+        log.info("speedcheckd listening on %s, warm: %s", self.path, ", ".join(sorted(self.warm)))
+
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        async with server:
+            await stop.wait()
+        log.info("speedcheckd shutting down")
+        await loop.run_in_executor(self.sync_worker, self.release)
+        self.sync_worker.shutdown()
+        self.async_worker.shutdown()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Resident speedcheck daemon that keeps provider engines warm"
+    )
+    parser.add_argument("--socket", help=f"Unix socket to listen on (default: {socket_path()})")
+    parser.add_argument("--no-browser", action="store_true", help="Do not keep a Chromium instance running")
+    parser.add_argument("--status", action="store_true", help="Print the status of a running speedcheckd and exit")
+    args = parser.parse_args(args)
+    path = args.socket or socket_path()
+
+    if not hasattr(socket, "AF_UNIX"):
+        sys.exit("speedcheckd needs Unix domain sockets")
+    if args.status:
+        if not available(path):
+            sys.exit("speedcheckd is not running")
+        print(json.dumps(request({"op": "status"}, path=path), indent=2))
+        return
+    if available(path):
+        sys.exit(f"speedcheckd is already running on {path}")
+    with contextlib.suppress(FileNotFoundError):
+        # Left behind by a daemon that did not shut down cleanly
+        os.unlink(path)
+
+    logging.basicConfig(
+        level=logging.INFO, format="[%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    # Providers print progress spinners and results, nobody reads them here
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        asyncio.run(Daemon(path, browser=not args.no_browser).serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import asyncio
+import contextlib
+import random
+import socket
+import time
+from typing import Optional
+
+import requests
+
+
+class SpeedcheckError(Exception):
+    """
+    A failed measurement with a machine readable `reason`, such as
+    "deadline_exceeded", "connect_timeout", "read_timeout",
+    "connection_failed", "http_error", "unsupported", "cancelled" or
+    "provider_error".
+    """
+
+    def __init__(self, reason: str, message: str = "", *, provider: Optional[str] = None, phase: Optional[str] = None) -> None:
+        super().__init__(message or reason)
+        self.reason = reason
+        self.message = message or reason
+        self.provider = provider
+        self.phase = phase
+
+    def to_dict(self) -> dict:
+        return {
+            "reason": self.reason,
+            "message": self.message,
+            "provider": self.provider,
+            "phase": self.phase,
+        }
+
+
+class DeadlineExceeded(SpeedcheckError):
+    def __init__(self, message: str = "Overall deadline exceeded", **kwargs) -> None:
+        super().__init__("deadline_exceeded", message, **kwargs)
+
+
+def classify(exc: BaseException) -> str:
+    """
+    Map an exception raised by requests, asyncio, websockets, speedtest-cli
+    or Playwright to a SpeedcheckError reason.
+    """
+    if isinstance(exc, SpeedcheckError):
+        return exc.reason
+    if isinstance(exc, requests.ConnectTimeout):
+        return "connect_timeout"
+    if isinstance(exc, requests.ReadTimeout):
+        return "read_timeout"
+    if isinstance(exc, requests.HTTPError):
+        return "http_error"
+    if isinstance(exc, (asyncio.TimeoutError, socket.timeout)) or type(exc).__name__ == "TimeoutError":
+        # Playwright's TimeoutError does not derive from the builtin one
+        return "timeout"
+    if isinstance(exc, (asyncio.CancelledError, KeyboardInterrupt)):
+        return "cancelled"
+    if isinstance(exc, (requests.ConnectionError, OSError)):
+        return "connection_failed"
+    return "provider_error"
+
+
+class Deadline:
+    """
+    An overall time budget shared by every step of a run.
+
+    Each network operation asks the deadline for its timeout, which is the
+    operation's own bound capped by the time that is left, so no single
+    step can hang past the end of the run. `Deadline()` without seconds
+    never expires but still enforces the per-operation bounds.
+    """
+
+    def __init__(self, seconds: Optional[float] = None) -> None:
+        self.expires = time.monotonic() + seconds if seconds is not None else None
+
+    def remaining(self) -> Optional[float]:
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.expires is not None and time.monotonic() >= self.expires
+
+    def check(self, provider: Optional[str] = None, phase: Optional[str] = None) -> None:
+        if self.expired:
+            raise DeadlineExceeded(provider=provider, phase=phase)
+
+    def sub(self, seconds: float) -> "Deadline":
+        """Return a deadline that ends after `seconds` or with this one."""
+        child = Deadline(seconds)
+        if self.expires is not None:
+            child.expires = min(child.expires, self.expires)
+        return child
+
+    def timeout(self, cap: float) -> float:
+        """Return `cap` bounded by the time left, raising if none is left."""
+        self.check()
+        remaining = self.remaining()
+        return cap if remaining is None else min(cap, remaining)
+
+    def requests_timeout(self, timeout=(10, 25)):
+        """Bound a requests (connect, read) timeout by the time left."""
+        if isinstance(timeout, tuple):
+            return tuple(self.timeout(part) for part in timeout)
+        return self.timeout(timeout)
+
+    def backoff(self, attempt: int, base: float = 0.5, cap: float = 8.0) -> None:
+        """
+        Sleep before retry number `attempt` using full jitter exponential
+        backoff, so clients that failed together do not retry in lockstep.
+        """
+        delay = random.uniform(0, min(cap, base * 2 ** attempt))
+        remaining = self.remaining()
+        if remaining is not None and delay >= remaining:
+            raise DeadlineExceeded()
+        time.sleep(delay)
+
+    async def wait_for(self, aw, cap: float, provider: Optional[str] = None, phase: Optional[str] = None):
+        """
+        Await `aw` for at most `cap` seconds or until the deadline. The
+        awaitable is cancelled on timeout, which closes any sockets it holds.
+        """
+        try:
+            timeout = self.timeout(cap)
+        except DeadlineExceeded:
+            # Never scheduled, close it so it is not reported as never awaited
+            if asyncio.iscoroutine(aw):
+                aw.close()
+            raise DeadlineExceeded(provider=provider, phase=phase) from None
+        try:
+            return await asyncio.wait_for(aw, timeout)
+        except asyncio.TimeoutError:
+            if self.expired:
+                raise DeadlineExceeded(provider=provider, phase=phase) from None
+            raise SpeedcheckError("timeout", f"No result within {cap:g} seconds", provider=provider, phase=phase) from None
+
+    @contextlib.contextmanager
+    def guard(self, provider: Optional[str] = None, phase: Optional[str] = None):
+        """
+        Turn any exception raised inside the block into a SpeedcheckError
+        that names the provider and phase it happened in.
+        """
+        try:
+            yield
+        except SpeedcheckError as error:
+            error.provider = error.provider or provider
+            error.phase = error.phase or phase
+            raise
+        except Exception as exc:
+            reason = "deadline_exceeded" if self.expired else classify(exc)
+            raise SpeedcheckError(reason, str(exc) or type(exc).__name__, provider=provider, phase=phase) from exc
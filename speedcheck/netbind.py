@@ -0,0 +1,173 @@
+import asyncio
+import ipaddress
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+from .deadline import SpeedcheckError
+from .summary import summarize
+
+# Providers whose traffic speedcheck opens itself and can therefore pin to a
+# source address. The browser based providers are driven by Chromium.
+BINDABLE = ("cloudflare", "mlab", "ookla", "ookla-native")
+
+
+class BindSpec(NamedTuple):
+    address: Optional[str]
+    interface: Optional[str]
+    family: int = socket.AF_UNSPEC
+
+    @property
+    def label(self) -> str:
+        if self.address and self.interface:
+            return f"{self.interface}/{self.address}"
+        if self.interface or self.address:
+            return self.interface or self.address
+        return {socket.AF_INET: "ipv4", socket.AF_INET6: "ipv6"}.get(self.family, "default")
+
+
+def parse_bind(value: Optional[str], family: int = socket.AF_UNSPEC) -> BindSpec:
+    """
+    Parse a --bind value, either a source IP address or an interface name,
+    into a BindSpec. `family` forces IPv4 (AF_INET) or IPv6 (AF_INET6).
+    """
+    if value is None:
+        return BindSpec(None, None, family)
+    try:
+        address = ipaddress.ip_address(value)
+    except ValueError:
+        if hasattr(socket, "if_nametoindex"):
+            try:
+                socket.if_nametoindex(value)
+            except OSError:
+                raise ValueError(f"{value} is neither an IP address nor a network interface") from None
+        if not hasattr(socket, "SO_BINDTODEVICE"):
+            raise ValueError("Binding to an interface is only supported on Linux, use its address instead")
+        return BindSpec(None, value, family)
+
+    address_family = socket.AF_INET if address.version == 4 else socket.AF_INET6
+    if family not in (socket.AF_UNSPEC, address_family):
+        raise ValueError(f"{value} does not match the forced IP version")
+    return BindSpec(str(address), None, address_family)
+
+
+def source_address(spec: BindSpec) -> Optional[tuple[str, int]]:
+    # A wildcard source of the forced family makes connection attempts to
+    # addresses of the other family fail, which forces the IP version.
+    if spec.address:
+        return (spec.address, 0)
+    if spec.family == socket.AF_INET:
+        return ("0.0.0.0", 0)
+    if spec.family == socket.AF_INET6:
+        return ("::", 0)
+    return None
+
+
+def socket_options(spec: BindSpec) -> list:
+    if not spec.interface:
+        return []
+    return [(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, spec.interface.encode())]
+
+
+class BoundHTTPAdapter(HTTPAdapter):
+    def __init__(self, spec: BindSpec, **kwargs) -> None:
+        self.spec = spec
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        address = source_address(self.spec)
+        if address:
+            kwargs["source_address"] = address
+        if self.spec.interface:
+            kwargs["socket_options"] = HTTPConnection.default_socket_options + socket_options(self.spec)
+        super().init_poolmanager(*args, **kwargs)
+
+
+def bound_session(spec: Optional[BindSpec], session: Optional[requests.Session] = None) -> requests.Session:
+    """
+    Return a requests session whose connections leave through `spec`.
+    """
+    session = session or requests.Session()
+    if spec:
+        adapter = BoundHTTPAdapter(spec)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+    return session
+
+
+async def connect_kwargs(uri: str, spec: Optional[BindSpec]) -> dict:
+    """
+    Return the extra keyword arguments for websockets.connect that pin the
+    connection to `spec`. Interface binding needs the socket option set
+    before connecting, so a connected socket is handed over in that case.
+    """
+    if not spec:
+        return {}
+    if not spec.interface:
+        kwargs = {"family": spec.family}
+        address = source_address(spec)
+        if address:
+            kwargs["local_addr"] = address
+        return kwargs
+
+    parts = urlsplit(uri)
+    port = parts.port or (443 if parts.scheme in ("wss", "https") else 80)
+    loop = asyncio.get_running_loop()
+    infos = await loop.getaddrinfo(parts.hostname, port, family=spec.family, type=socket.SOCK_STREAM)
+    error = None
+    for family, type_, proto, _, address in infos:
+        sock = socket.socket(family, type_, proto)
+        try:
+            for level, option, value in socket_options(spec):
+                sock.setsockopt(level, option, value)
+            sock.setblocking(False)
+            await loop.sock_connect(sock, address)
+            return {"sock": sock}
+        except OSError as exc:
+            sock.close()
+            error = exc
+        except BaseException:
+            # Cancelled by a timeout, do not leak the socket
+            sock.close()
+            raise
+    raise error or OSError(f"Could not resolve {parts.hostname}")
+
+
+def run_multi(runner, specs: list[BindSpec], progress_factory=None, deadline=None) -> dict:
+    """
+    Run `runner` on every link in `specs` at the same time and add up the
+    download and upload rates to get the total multi-WAN capacity. A link
+    that fails is reported with its error and counts as zero.
+    """
+    def run_link(spec):
+        kwargs = {"bind": spec}
+        if progress_factory:
+            kwargs["progress"] = progress_factory(spec)
+        if deadline:
+            kwargs["deadline"] = deadline
+        try:
+            return runner(**kwargs)
+        except SpeedcheckError as error:
+            return {"Error": error.to_dict()}
+
+    with ThreadPoolExecutor(max_workers=len(specs)) as pool:
+        results = list(pool.map(run_link, specs))
+
+    links = {}
+    total_download = total_upload = 0.0
+    for spec, result in zip(specs, results):
+        links[spec.label] = result
+        summary = summarize(result or {})
+        total_download += summary["download_mbps"] or 0
+        total_upload += summary["upload_mbps"] or 0
+
+    return {
+        "Links": links,
+        "Total Download Speed": f"{round(total_download, 2)} Mbps",
+        "Total Upload Speed": f"{round(total_upload, 2)} Mbps",
+    }
@@ -0,0 +1,258 @@
+import asyncio
+import json
+import socket
+import ssl
+import time
+from typing import NamedTuple, Optional
+from urllib.parse import urlsplit
+
+from .netbind import BindSpec, connect_kwargs
+from .speedtest_cflare import TestTimers, _calculate_percentile
+
+
+class ProbeTarget(NamedTuple):
+    host: str
+    port: int
+    tls: bool = False
+    path: str = "/"
+
+    @property
+    def uri(self) -> str:
+        return f"{'https' if self.tls else 'http'}://{self.host}:{self.port}{self.path}"
+
+
+class ProbeStats(NamedTuple):
+    mode: str
+    target: str
+    sent: int
+    received: int
+    loss: float
+    min_ms: Optional[float]
+    p50_ms: Optional[float]
+    p90_ms: Optional[float]
+    p99_ms: Optional[float]
+    max_ms: Optional[float]
+    mean_ms: Optional[float]
+    jitter_ms: Optional[float]
+
+
+def summarize_rtts(mode: str, target: ProbeTarget, rtts: list[Optional[float]]) -> ProbeStats:
+    """
+    Build distribution statistics from probe round trip times in send order,
+    with None for probes that were lost.
+    """
+    samples = [rtt for rtt in rtts if rtt is not None]
+    sent = len(rtts)
+
+    def pct(p):
+        return round(_calculate_percentile(samples, p), 3) if samples else None
+
+    jitter = TestTimers.jitter_from(samples)
+    return ProbeStats(
+        mode=mode,
+        target=target.uri,
+        sent=sent,
+        received=len(samples),
+        loss=round((sent - len(samples)) / sent, 4) if sent else 0.0,
+        min_ms=round(min(samples), 3) if samples else None,
+        p50_ms=pct(0.5),
+        p90_ms=pct(0.9),
+        p99_ms=pct(0.99),
+        max_ms=round(max(samples), 3) if samples else None,
+        mean_ms=round(sum(samples) / len(samples), 3) if samples else None,
+        jitter_ms=round(jitter, 3) if jitter is not None else None,
+    )
+
+
+class _Connector:
+    """Opens connections to a resolved target address, honouring --bind."""
+
+    def __init__(self, target: ProbeTarget, bind: Optional[BindSpec]) -> None:
+        self.target = target
+        self.bind = bind
+        self.address = None
+        self.ssl = ssl.create_default_context() if target.tls else None
+
+    async def resolve(self) -> None:
+        # Resolve once up front so probes do not include DNS lookups
+        family = self.bind.family if self.bind else socket.AF_UNSPEC
+        infos = await asyncio.get_running_loop().getaddrinfo(
+            self.target.host, self.target.port, family=family, type=socket.SOCK_STREAM
+        )
+        self.address = infos[0][4][0]
+
+    async def open(self, *, tls: bool = True):
+        uri = f"tcp://{self.address}:{self.target.port}/"
+        if ":" in self.address:
+            uri = f"tcp://[{self.address}]:{self.target.port}/"
+        kwargs = await connect_kwargs(uri, self.bind)
+        if tls and self.ssl:
+            kwargs["ssl"] = self.ssl
+            kwargs["server_hostname"] = self.target.host
+        if "sock" in kwargs:
+            return await asyncio.open_connection(**kwargs)
+        return await asyncio.open_connection(self.address, self.target.port, **kwargs)
+
+
+async def _tcp_probe(connector: _Connector, timeout: float) -> Optional[float]:
+    start = time.perf_counter()
+    try:
+        _, writer = await asyncio.wait_for(connector.open(tls=False), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    rtt = (time.perf_counter() - start) * 1e3
+    writer.close()
+    return rtt
+
+
+class _KeepAliveConnection:
+    def __init__(self, connector: _Connector) -> None:
+        self.connector = connector
+        self.reader = None
+        self.writer = None
+        target = connector.target
+        self.request = (
+            f"GET {target.path} HTTP/1.1\r\n"
+            f"Host: {target.host}\r\n"
+            "Connection: keep-alive\r\n"
+            "User-Agent: speedcheck\r\n\r\n"
+        ).encode()
+
+    async def probe(self, timeout: float) -> Optional[float]:
+        try:
+            if self.writer is None:
+                # Connection setup is not part of the measured round trip
+                self.reader, self.writer = await asyncio.wait_for(self.connector.open(), timeout)
+            start = time.perf_counter()
+            await asyncio.wait_for(self._exchange(), timeout)
+            return (time.perf_counter() - start) * 1e3
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+            self.close()
+            return None
+
+    async def _exchange(self) -> None:
+        self.writer.write(self.request)
+        await self.writer.drain()
+        headers = await self.reader.readuntil(b"\r\n\r\n")
+        length = 0
+        keep_alive = True
+        for line in headers.split(b"\r\n")[1:]:
+            name, _, value = line.partition(b":")
+            name = name.strip().lower()
+            if name == b"content-length":
+                length = int(value)
+            elif name == b"connection" and value.strip().lower() == b"close":
+                keep_alive = False
+            elif name == b"transfer-encoding":
+                raise ValueError("chunked responses are not supported for probing")
+        if length:
+            await self.reader.readexactly(length)
+        if not keep_alive:
+            self.close()
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+async def run_probes(
+    target: ProbeTarget,
+    mode: str = "tcp",
+    rate: float = 200,
+    duration: float = 5.0,
+    timeout: float = 1.0,
+    concurrency: int = 32,
+    bind: Optional[BindSpec] = None,
+) -> ProbeStats:
+    """
+    Send `rate` probes per second to `target` for `duration` seconds.
+
+    In "tcp" mode every probe is a fresh TCP connect. In "http" mode probes
+    are GET requests over a pool of `concurrency` keep-alive connections.
+    Probes are paced on a fixed schedule so slow replies do not lower the
+    send rate; a probe without a reply within `timeout` counts as lost.
+    """
+    if mode not in ("tcp", "http"):
+        raise ValueError(f"Unknown probe mode: {mode}")
+    connector = _Connector(target, bind)
+    await connector.resolve()
+
+    count = max(1, int(rate * duration))
+    rtts: list[Optional[float]] = [None] * count
+    idle: asyncio.Queue = asyncio.Queue()
+    for _ in range(concurrency):
+        idle.put_nowait(_KeepAliveConnection(connector))
+    limit = asyncio.Semaphore(concurrency)
+
+    async def probe(index):
+        if mode == "tcp":
+            async with limit:
+                rtts[index] = await _tcp_probe(connector, timeout)
+            return
+        connection = await idle.get()
+        try:
+            rtts[index] = await connection.probe(timeout)
+        finally:
+            idle.put_nowait(connection)
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    tasks = []
+    for index in range(count):
+        delay = start + index / rate - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(probe(index)))
+    await asyncio.gather(*tasks)
+
+    while not idle.empty():
+        idle.get_nowait().close()
+    return summarize_rtts(mode, target, rtts)
+
+
+def _ookla_target(bind):
+    import speedtest
+
+    from .netbind import source_address
+
+    source = source_address(bind) if bind else None
+    st = speedtest.Speedtest(source_address=source[0] if source else None)
+    st.get_servers()
+    server = st.get_closest_servers(limit=1)[0]
+    parts = urlsplit(server["url"])
+    path = parts.path.rsplit("/", 1)[0] + "/latency.txt"
+    return ProbeTarget(parts.hostname, parts.port or 80, parts.scheme == "https", path)
+
+
+def _mlab_target(bind):
+    from .speedtest_mlab import get_nearest_server
+
+    server = get_nearest_server(bind)["results"][0]
+    parts = urlsplit(server["urls"]["ws:///ndt/v7/download"])
+    return ProbeTarget(parts.hostname, parts.port or 80, False, "/")
+
+
+def probe_target(provider: str, bind: Optional[BindSpec] = None) -> ProbeTarget:
+    """
+    Return the endpoint a provider would measure against.
+    """
+    if provider == "cloudflare":
+        return ProbeTarget("speed.cloudflare.com", 443, True, "/__down?bytes=0")
+    if provider == "mlab":
+        return _mlab_target(bind)
+    if provider == "ookla":
+        return _ookla_target(bind)
+    raise ValueError(f"Latency probing is only supported for cloudflare, mlab and ookla, not {provider}")
+
+
+def probe_speed_test(provider, mode="tcp", rate=200, duration=5.0, timeout=1.0, concurrency=32, bind=None):
+    """
+    Probe the latency of `provider`'s server and print the distribution.
+    """
+    target = probe_target(provider, bind)
+    print(f"\nProbing {target.uri} ({mode}, {rate:g}/s for {duration:g}s)\n")
+    stats = asyncio.run(run_probes(target, mode, rate, duration, timeout, concurrency, bind))
+    result_dict = stats._asdict()
+    print(json.dumps(result_dict, indent=2))
+    return result_dict
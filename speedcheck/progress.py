@@ -0,0 +1,147 @@
+import asyncio
+import json
+import sys
+import threading
+import time
+from typing import Callable, NamedTuple, Optional
+
+
+class ProgressEvent(NamedTuple):
+    time: float
+    provider: str
+    phase: str
+    bytes: int
+    elapsed: float
+    instant_mbps: Optional[float]
+    mean_mbps: Optional[float]
+    done: bool = False
+
+
+ProgressCallback = Callable[[ProgressEvent], None]
+
+
+def _mbps(nbytes, seconds):
+    if seconds <= 0:
+        return None
+    return round(nbytes * 8 / 1_000_000 / seconds, 2)
+
+
+class ProgressReporter:
+    """
+    Rate limited progress reporting for a single provider run.
+
+    Providers call `phase()` when a new phase (latency, download, upload)
+    starts and `update()` with the cumulative number of bytes moved in that
+    phase. `update()` only does a clock read and a comparison unless an event
+    is due, so it is cheap enough to call from inside the transfer loop.
+    Phase changes and `finish()` always emit an event.
+    """
+
+    def __init__(self, provider: str, *callbacks: ProgressCallback, interval: float = 0.25) -> None:
+        self.provider = provider
+        self.callbacks = list(callbacks)
+        self.interval = interval
+        self.current_phase = None
+        self._phase_start = 0.0
+        self._next_emit = 0.0
+        self._last_time = 0.0
+        self._last_bytes = 0
+        self._bytes = 0
+
+    def add_callback(self, callback: ProgressCallback) -> None:
+        self.callbacks.append(callback)
+
+    def phase(self, name: str) -> None:
+        if self.current_phase == name:
+            return
+        if self.current_phase is not None:
+            self._emit(time.monotonic(), done=True)
+        now = time.monotonic()
+        self.current_phase = name
+        self._phase_start = now
+        self._last_time = now
+        self._last_bytes = 0
+        self._bytes = 0
+        self._next_emit = now + self.interval
+        self._emit(now)
+
+    def update(self, total_bytes: int) -> None:
+        self._bytes = total_bytes
+        now = time.monotonic()
+        if now < self._next_emit:
+            return
+        self._next_emit = now + self.interval
+        self._emit(now)
+
+    def finish(self) -> None:
+        if self.current_phase is None:
+            return
+        self._emit(time.monotonic(), done=True)
+        self.current_phase = None
+
+    def _emit(self, now: float, *, done: bool = False) -> None:
+        event = ProgressEvent(
+            time=time.time(),
+            provider=self.provider,
+            phase=self.current_phase,
+            bytes=self._bytes,
+            elapsed=round(now - self._phase_start, 3),
+            instant_mbps=_mbps(self._bytes - self._last_bytes, now - self._last_time),
+            mean_mbps=_mbps(self._bytes, now - self._phase_start),
+            done=done,
+        )
+        self._last_time = now
+        self._last_bytes = self._bytes
+        for callback in self.callbacks:
+            callback(event)
+
+
+def ndjson_writer(stream=None) -> ProgressCallback:
+    """
+    Return a progress callback that writes each event as one JSON line.
+    The callback can be shared by reporters running in different threads.
+    """
+    lock = threading.Lock()
+
+    def write(event: ProgressEvent) -> None:
+        out = stream or sys.stdout
+        line = json.dumps({"event": "progress", **event._asdict()}) + "\n"
+        with lock:
+            out.write(line)
+            out.flush()
+
+    return write
+
+
+async def stream(provider: str, *, interval: float = 0.25, **options):
+    """
+    Run `provider` in a worker thread and yield its ProgressEvents as they
+    are produced.
+
+        async for event in stream("cloudflare"):
+            print(event.phase, event.mean_mbps)
+
+    Events are handed over with call_soon_threadsafe, so they arrive in order
+    and before the completion marker. Exceptions raised by the provider are
+    re-raised after the last event has been yielded.
+    """
+    from .providers import get_runner
+
+    runner = get_runner(provider)
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    finished = object()
+
+    def push(event):
+        loop.call_soon_threadsafe(queue.put_nowait, event)
+
+    reporter = ProgressReporter(provider, push, interval=interval)
+    task = asyncio.ensure_future(asyncio.to_thread(runner, progress=reporter, **options))
+    task.add_done_callback(lambda _: queue.put_nowait(finished))
+
+    while True:
+        event = await queue.get()
+        if event is finished:
+            break
+        yield event
+    task.result()
@@ -17,27 +17,35 @@ limitations under the License.
 __license__ = "Apache 2.0"
 
 import argparse
+import contextlib
 import importlib
 import json
 import logging
 import os
+import socket
 import subprocess
 import sys
+import time
 import webbrowser
 from importlib.metadata import version
 
+# Reference point for the start latency of runs that do not use speedcheckd
+_STARTED = time.perf_counter()
+
 import requests
 
 os.chdir(os.path.dirname(os.path.realpath(__file__)))
 lpath = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(lpath)
 
-from .speedtest_cflare import cflare_speedtest
-from .speedtest_fast import fast_speed_test
-from .speedtest_mlab import mlab_speed_test
-from .speedtest_ookla import ookla_speed_test
-from .speedtest_openspeedtest import openspeedtest_speed_test
-from .speedtest_speedsmart import speedsmart_speed_test
+from . import daemon as speedcheckd
+from .cache import cache_key, single_flight
+from .changepoint import check as detect_changes
+from .deadline import Deadline, SpeedcheckError
+from .netbind import BINDABLE, parse_bind
+from .probe import probe_speed_test
+from .progress import ProgressReporter, ndjson_writer
+from .providers import PROVIDERS, run_provider
 
 # Set a custom log formatter
 logging.basicConfig(
@@ -85,6 +93,7 @@ def install_version(package):
 def speedcheck_version(package):
     """
     Check and notify about the latest version of the 'speedcheck' package.
+    Notices go to stderr so they never mix with --ndjson output.
     """
     latest_version = version_latest(package)
     installed_version = install_version(package)
@@ -95,18 +104,20 @@ def speedcheck_version(package):
         )
         if vcheck == 1:
             print(
-                f"Current version of speedcheck is {installed_version} upgrade to latest version: {latest_version}"
+                f"Current version of speedcheck is {installed_version} upgrade to latest version: {latest_version}",
+                file=sys.stderr,
             )
         elif vcheck == -1:
             print(
-                f"Possibly running staging code {installed_version} compared to pypi release {latest_version}"
+                f"Possibly running staging code {installed_version} compared to pypi release {latest_version}",
+                file=sys.stderr,
             )
     elif latest_version is None and installed_version is not None:
-        print(f"Package {package} not found on PyPI")
+        print(f"Package {package} not found on PyPI", file=sys.stderr)
     elif latest_version is not None and installed_version is None:
-        print(f"Package {package} not installed")
+        print(f"Package {package} not installed", file=sys.stderr)
     elif latest_version is None and installed_version is None:
-        print(f"Package {package} not found on PyPI and not installed")
+        print(f"Package {package} not found on PyPI and not installed", file=sys.stderr)
 
 speedcheck_version("speedcheck")
 
@@ -146,6 +157,7 @@ def speedcheck_info():
     speedcheck_dict["cloudflare"] = "Runs speedtest from Cloudflare: speed.cloudflare.com"
     speedcheck_dict["fast"] = "Runs speedtest from fast.com"
     speedcheck_dict["ookla"] = "Runs speedtest from Ookla speedtest: speedtest.ookla.com"
+    speedcheck_dict["ookla-native"] = "Runs the Ookla speedtest with speedcheck's own asyncio engine"
     speedcheck_dict["mlab"] = "Runs speedtest from mlab: speedtest.mlab.com"
     speedcheck_dict["openspeedtest"] = "Runs speedtest from Open Speed Test: openspeedtest.com"
     speedcheck_dict["speedsmart"] = "Runs speedtest from Speed Smart: speedsmart.net"
@@ -156,25 +168,144 @@ def speedcheck_info_from_parser(args):
     speedcheck_info()
 
 
-def speedcheck_run(speedtest):
-    if speedtest == "cloudflare":
-        cflare_speedtest()
-    elif speedtest == "fast":
-        fast_speed_test()
-    elif speedtest == "ookla":
-        ookla_speed_test()
-    elif speedtest == "mlab":
-        mlab_speed_test()
-    elif speedtest == "openspeedtest":
-        openspeedtest_speed_test()
-    elif speedtest == "speedsmart":
-        speedsmart_speed_test()
-    else:
-        print("Invalid speedtest type")
+def speedcheck_run(speedtest, ndjson=False, interval=0.25, binds=None, family=socket.AF_UNSPEC, multi=False, max_age=None, timeout=None, use_daemon=True, max_cross_traffic=None, reruns=0, detect=False, streams=None):
+    if speedtest not in PROVIDERS:
+        print("Invalid speedtest type", file=sys.stderr)
+        return
+    try:
+        specs = [parse_bind(value, family) for value in binds or []]
+    except ValueError as error:
+        sys.exit(f"Invalid --bind: {error}")
+    if not specs and family != socket.AF_UNSPEC:
+        specs = [parse_bind(None, family)]
+    if specs and speedtest not in BINDABLE:
+        sys.exit(f"Source binding is only supported for: {', '.join(BINDABLE)}")
+    if multi and len(specs) < 2:
+        sys.exit("--multi needs at least two --bind links")
+    if streams is not None and speedtest != "ookla-native":
+        sys.exit("--streams is only supported for ookla-native")
+    if streams is not None and streams < 1:
+        sys.exit("--streams must be at least 1")
+    options = {"streams": streams} if streams else {}
+
+    out = sys.stdout
+    writer = ndjson_writer(out) if ndjson else None
+    remote = use_daemon and speedcheckd.available()
+    timing = {}
+
+    def on_event(event):
+        timing.setdefault("start_latency_s", round(time.perf_counter() - _STARTED, 3))
+        writer(event)
+
+    def reporter(spec=None):
+        name = f"{speedtest}@{spec.label}" if spec and len(specs) > 1 else speedtest
+        return ProgressReporter(name, on_event, interval=interval)
+
+    def forward(event):
+        # Progress relayed by speedcheckd is already a JSON ready dict
+        out.write(json.dumps(event) + "\n")
+        out.flush()
+
+    def emit(result, cached):
+        if ndjson:
+            event = {"event": "result", "provider": speedtest, "cached": cached, "daemon": remote, "timing": timing, "result": result}
+            out.write(json.dumps(event) + "\n")
+            out.flush()
+        elif multi or cached or remote:
+            print(json.dumps(result, indent=2), file=out)
+        elif "Client CPU" in result:
+            # The provider already printed the rest of the result
+            checks = {key: result.get(key) for key in ("Client CPU", "Cross Traffic", "Attempts") if key in result}
+            print(json.dumps(checks, indent=2), file=out)
+        if not ndjson and result.get("Client CPU", {}).get("client_bound"):
+            print("\nA CPU core was saturated during the test, the result may be limited by this machine rather than the link\n", file=sys.stderr)
+        if not ndjson and (result.get("Cross Traffic") or {}).get("contaminated"):
+            print("\nOther traffic shared the interface during the test, the result may understate the link\n", file=sys.stderr)
+
+    deadline = Deadline(timeout)
+
+    def measure():
+        if remote:
+            reply = speedcheckd.run_remote(
+                speedtest, binds, family, multi, timeout, forward if ndjson else None, interval,
+                cross_traffic_limit=max_cross_traffic, reruns=reruns, streams=streams,
+            )
+            timing.update(reply["timing"])
+            return reply["results"]
+        # Keep stdout clean for NDJSON and the combined multi-WAN report,
+        # provider output goes to stderr
+        quiet = contextlib.redirect_stdout(sys.stderr) if ndjson or multi else contextlib.nullcontext()
+        with quiet, deadline.guard(speedtest):
+            return run_provider(
+                speedtest, specs, multi, deadline, reporter if ndjson else None, max_cross_traffic, reruns, **options
+            )
+
+    cached = False
+    try:
+        if max_age is None:
+            results = measure()
+        else:
+            key = cache_key(
+                speedtest, *[spec.label for spec in specs], "multi" if multi else None,
+                f"streams={streams}" if streams else None,
+            )
+            with deadline.guard(speedtest):
+                results, cached = single_flight(key, max_age, measure, deadline)
+    except SpeedcheckError as error:
+        if ndjson:
+            out.write(json.dumps({"event": "error", "provider": speedtest, "error": error.to_dict()}) + "\n")
+            out.flush()
+        else:
+            print("\n" + json.dumps({"Error": error.to_dict()}, indent=2))
+        sys.exit(1)
+    if cached and not ndjson:
+        print(f"\nUsing cached {speedtest} result\n", file=sys.stderr)
+    elif remote and not ndjson:
+        print(f"\nRan {speedtest} through speedcheckd, started in {timing.get('start_latency_s')} seconds\n", file=sys.stderr)
+    for result in results:
+        emit(result, cached)
+    # A cached result was already counted by the run that measured it
+    if detect and not cached:
+        for alert in detect_changes(speedtest, results, specs, multi):
+            if ndjson:
+                out.write(json.dumps({"event": "alert", **alert._asdict()}) + "\n")
+                out.flush()
+            else:
+                print(json.dumps({"Alert": alert._asdict()}, indent=2), file=out)
 
 
 def speedcheck_run_from_parser(args):
-    speedcheck_run(speedtest=args.type)
+    speedcheck_run(
+        speedtest=args.type,
+        ndjson=args.ndjson,
+        interval=args.interval,
+        binds=args.bind,
+        family=args.family,
+        multi=args.multi,
+        max_age=args.max_age,
+        timeout=args.timeout,
+        use_daemon=not args.no_daemon,
+        max_cross_traffic=args.max_cross_traffic,
+        reruns=args.rerun,
+        detect=args.detect,
+        streams=args.streams,
+    )
+
+
+def speedcheck_probe_from_parser(args):
+    try:
+        bind = parse_bind(args.bind, args.family) if args.bind or args.family else None
+        probe_speed_test(
+            args.type,
+            mode=args.mode,
+            rate=args.rate,
+            duration=args.duration,
+            timeout=args.timeout,
+            concurrency=args.concurrency,
+            bind=bind,
+        )
+    except ValueError as error:
+        sys.exit(str(error))
 
 
 # spacing = "                               "
@@ -208,11 +339,125 @@ def main(args=None):
     required_named = parser_run.add_argument_group("Required named arguments.")
     required_named.add_argument(
         "--type",
-        help="Speedtest type: cloudflare, fast, ookla, mlab, openspeedtest, speedsmart",
+        help="Speedtest type: cloudflare, fast, ookla, ookla-native, mlab, openspeedtest, speedsmart",
         required=True,
     )
+    optional_named = parser_run.add_argument_group("Optional named arguments")
+    optional_named.add_argument(
+        "--ndjson",
+        action="store_true",
+        help="Stream timestamped progress events as newline delimited JSON on stdout",
+    )
+    optional_named.add_argument(
+        "--interval",
+        type=float,
+        default=0.25,
+        help="Seconds between progress events in --ndjson mode (default: 0.25)",
+    )
+    optional_named.add_argument(
+        "--bind",
+        action="append",
+        help="Source IP address or interface to run the test from, can be repeated (cloudflare, mlab, ookla, ookla-native)",
+    )
+    family_group = optional_named.add_mutually_exclusive_group()
+    family_group.add_argument(
+        "-4",
+        dest="family",
+        action="store_const",
+        const=socket.AF_INET,
+        default=socket.AF_UNSPEC,
+        help="Force IPv4",
+    )
+    family_group.add_argument(
+        "-6",
+        dest="family",
+        action="store_const",
+        const=socket.AF_INET6,
+        help="Force IPv6",
+    )
+    optional_named.add_argument(
+        "--multi",
+        action="store_true",
+        help="Measure all --bind links at the same time and report the total capacity",
+    )
+    optional_named.add_argument(
+        "--max-age",
+        type=float,
+        help="Reuse a result measured within this many seconds; concurrent runs wait for and share one measurement",
+    )
+    optional_named.add_argument(
+        "--timeout",
+        type=float,
+        help="Overall deadline in seconds for the run, every network step is bounded by it",
+    )
+    optional_named.add_argument(
+        "--max-cross-traffic",
+        type=float,
+        help="Share of the egress interface traffic from other sources above which a result is flagged (default: 0.1)",
+    )
+    optional_named.add_argument(
+        "--rerun",
+        type=int,
+        default=0,
+        help="Repeat a flagged run up to this many times and keep the cleanest attempt",
+    )
+    optional_named.add_argument(
+        "--detect",
+        action="store_true",
+        help="Track results over time and print an alert when download, upload or latency shifts",
+    )
+    optional_named.add_argument(
+        "--streams",
+        type=int,
+        help="Parallel connections per phase for ookla-native (default: the server's own configuration)",
+    )
+    optional_named.add_argument(
+        "--no-daemon",
+        action="store_true",
+        help="Run in this process even when speedcheckd is running",
+    )
     parser_run.set_defaults(func=speedcheck_run_from_parser)
 
+    parser_probe = subparsers.add_parser(
+        "probe", help="Probes latency to a provider's server at a high rate and reports the distribution"
+    )
+    required_named = parser_probe.add_argument_group("Required named arguments.")
+    required_named.add_argument(
+        "--type",
+        help="Speedtest type: cloudflare, mlab, ookla",
+        required=True,
+    )
+    optional_named = parser_probe.add_argument_group("Optional named arguments")
+    optional_named.add_argument(
+        "--mode",
+        choices=("tcp", "http"),
+        default="tcp",
+        help="tcp: time TCP connects, http: time requests over keep-alive connections (default: tcp)",
+    )
+    optional_named.add_argument(
+        "--rate", type=float, default=200, help="Probes per second (default: 200)"
+    )
+    optional_named.add_argument(
+        "--duration", type=float, default=5.0, help="Seconds to probe for (default: 5)"
+    )
+    optional_named.add_argument(
+        "--timeout", type=float, default=1.0, help="Seconds before a probe counts as lost (default: 1)"
+    )
+    optional_named.add_argument(
+        "--concurrency", type=int, default=32, help="Maximum probes in flight (default: 32)"
+    )
+    optional_named.add_argument(
+        "--bind", help="Source IP address or interface to probe from"
+    )
+    family_group = optional_named.add_mutually_exclusive_group()
+    family_group.add_argument(
+        "-4", dest="family", action="store_const", const=socket.AF_INET, default=socket.AF_UNSPEC, help="Force IPv4"
+    )
+    family_group.add_argument(
+        "-6", dest="family", action="store_const", const=socket.AF_INET6, help="Force IPv6"
+    )
+    parser_probe.set_defaults(func=speedcheck_probe_from_parser)
+
     args = parser.parse_args()
 
     try:
@@ -7,6 +7,10 @@ from typing import Any, NamedTuple
 
 import requests
 
+from .deadline import Deadline
+from .netbind import BindSpec, bound_session
+from .progress import ProgressReporter
+
 log = logging.getLogger("cfspeedtest")
 
 class TestType(Enum):
@@ -96,21 +100,30 @@ def _calculate_percentile(data: list[float], percentile: float) -> float:
 SuiteResults = dict[str, dict[str, TestResult]]
 
 class CloudflareSpeedtest:
-    def __init__(self, results: SuiteResults | None = None, tests: TestSpecs = DEFAULT_TESTS, timeout: tuple[float, float] | float = (10, 25)) -> None:
+    def __init__(self, results: SuiteResults | None = None, tests: TestSpecs = DEFAULT_TESTS, timeout: tuple[float, float] | float = (10, 25), progress: ProgressReporter | None = None, bind: BindSpec | None = None, deadline: Deadline | None = None, session: requests.Session | None = None) -> None:
         self.results = results or {}
         self.results.setdefault("tests", {})
         self.results.setdefault("meta", {})
 
         self.tests = tests
-        self.request_sess = requests.Session()
+        self.request_sess = bound_session(bind, session)
         self.timeout = timeout
+        self.progress = progress
+        self.deadline = deadline or Deadline()
+        self._phase_bytes = 0
 
     def get_location_data(self, ip_address: str, max_retries: int = 3) -> dict[str, str | float]:
         url = f'https://json.geoiplookup.io/{ip_address}'
         attempt = 0
 
         while attempt < max_retries:
-            response = requests.get(url)
+            if attempt:
+                self.deadline.backoff(attempt)
+            try:
+                response = self.request_sess.get(url, timeout=self.deadline.requests_timeout((5, 10)))
+            except requests.RequestException:
+                attempt += 1
+                continue
             if response.status_code == 200:
                 response_data = response.json()
                 return {
@@ -127,9 +140,13 @@ class CloudflareSpeedtest:
         return {"region": "NA"}
 
     def metadata(self) -> TestMetadata:
-        result_data: dict[str, str] = self.request_sess.get(
-            "https://speed.cloudflare.com/meta"
-        ).json()
+        with self.deadline.guard("cloudflare", "metadata"):
+            response = self.request_sess.get(
+                "https://speed.cloudflare.com/meta",
+                timeout=self.deadline.requests_timeout(self.timeout),
+            )
+            response.raise_for_status()
+            result_data: dict[str, str] = response.json()
 
         ip_address = result_data["clientIp"]
         location_data = self.get_location_data(ip_address)
@@ -150,10 +167,13 @@ class CloudflareSpeedtest:
             data = b"".zfill(test.size)
 
         for _ in range(test.iterations):
-            start = time.time()
-            r = self.request_sess.request(
-                test.type.value, url, data=data, timeout=self.timeout
-            )
+            with self.deadline.guard("cloudflare", test.name):
+                timeout = self.deadline.requests_timeout(self.timeout)
+                start = time.time()
+                r = self.request_sess.request(
+                    test.type.value, url, data=data, timeout=timeout
+                )
+                r.raise_for_status()
             coll.full.append(time.time() - start)
             coll.server.append(
                 float(r.headers["Server-Timing"].split("=")[1].split(",")[0]) / 1e3
@@ -161,8 +181,19 @@ class CloudflareSpeedtest:
             coll.request.append(
                 r.elapsed.seconds + r.elapsed.microseconds / 1e6
             )
+            if self.progress:
+                self._phase_bytes += test.size
+                self.progress.update(self._phase_bytes)
         return coll
 
+    def _start_phase(self, test: TestSpec) -> None:
+        if not self.progress:
+            return
+        phase = "latency" if test.name == "latency" else f"{test.type.name.lower()}load"
+        if phase != self.progress.current_phase:
+            self._phase_bytes = 0
+            self.progress.phase(phase)
+
     def _sprint(self, label: str, result: TestResult, *, meta: bool = False) -> None:
         #log.info("%s: %s", label, result.value)
         save_to = self.results["meta"] if meta else self.results["tests"]
@@ -181,6 +212,7 @@ class CloudflareSpeedtest:
 
         data = {"down": [], "up": []}
         for test in self.tests:
+            self._start_phase(test)
             timers = self.run_test(test)
             print(f"\r{animation[animation_index % len(animation)]} Running speed test...", end="")
             animation_index += 1
@@ -223,6 +255,8 @@ class CloudflareSpeedtest:
             )
         print(f"\r{animation[animation_index % len(animation)]} Running speed test...", end="")
         animation_index += 1
+        if self.progress:
+            self.progress.finish()
         return self.results
 
     @staticmethod
@@ -233,10 +267,16 @@ class CloudflareSpeedtest:
             for sk, sv in v.items()
         }
 
-def cflare_speedtest():
+def cflare_speedtest(progress=None, bind=None, deadline=None, session=None):
     print("\nRunning Cloudflare Speed Test (speed.cloudflare.com)\n")
-    speedtest = CloudflareSpeedtest()
-    data = speedtest.run_all()
+    speedtest = CloudflareSpeedtest(progress=progress, bind=bind, deadline=deadline, session=session)
+    try:
+        data = speedtest.run_all()
+        metadata = speedtest.metadata()
+    finally:
+        # A session passed in by the caller is kept open for its next run
+        if session is None:
+            speedtest.request_sess.close()
     for key in data:
         for subkey in data[key]:
             data[key][subkey] = [item[0] for item in data[key][subkey]]
@@ -249,12 +289,12 @@ def cflare_speedtest():
     }
 
     # Print metadata
-    metadata = speedtest.metadata()
     result_dict["IP"] = metadata.ip
     result_dict["ISP"] = metadata.isp
     result_dict["Location Code"] = metadata.location_code
     result_dict["Region"] = metadata.region
     print("\n"+json.dumps(result_dict, indent=2))
+    return result_dict
 
 if __name__ == "__main__":
     cflare_speedtest()
@@ -1,9 +1,17 @@
 import asyncio
 import json
+import math
 
 from deepdiff import DeepDiff
 from playwright.async_api import async_playwright
 
+from .cdp import NetworkMeter
+from .deadline import Deadline, DeadlineExceeded
+
+# Upper bounds for loading fast.com and for the whole measurement
+PAGE_TIMEOUT = 60
+TEST_TIMEOUT = 120
+
 
 class Options:
     def __init__(self, measure_upload=False):
@@ -27,13 +35,20 @@ class Result:
             return self.__dict__ == other.__dict__
         return False
 
-async def monitor_speed(page, options=None):
+def _to_bytes(megabytes):
+    # Number() of a missing element comes back as NaN
+    if megabytes is None or math.isnan(megabytes):
+        return 0
+    return int(megabytes * 1_000_000)
+
+async def monitor_speed(page, options=None, progress=None, deadline=None):
     previous_result = None
     iteration = 0
     animation = "|/-\\"
     animation_index = 0
+    deadline = (deadline or Deadline()).sub(TEST_TIMEOUT)
 
-    while True:
+    while not deadline.expired:
         result = await page.evaluate('''() => {
             const $ = document.querySelector.bind(document);
 
@@ -48,9 +63,20 @@ async def monitor_speed(page, options=None):
                 userLocation: $('#user-location')?.textContent?.trim(),
                 userIp: $('#user-ip')?.textContent?.trim(),
                 isDone: Boolean($('#speed-value.succeeded') && $('#upload-value.succeeded')),
+                downloadDone: Boolean($('#speed-value.succeeded')),
+                uploaded: Number($('#up-mb-value')?.textContent?.trim()),
             };
         }''')
 
+        if progress:
+            # fast.com reports transferred megabytes, so the stream follows the page
+            if result['downloadDone']:
+                progress.phase("upload")
+                progress.update(_to_bytes(result['uploaded']))
+            else:
+                progress.phase("download")
+                progress.update(_to_bytes(result['downloaded']))
+
         result = Result(
             result['downloadSpeed'], result['uploadSpeed'], result['downloadUnit'], result['downloaded'],
             result['uploadUnit'], result['latency'], result['bufferBloat'],
@@ -58,6 +84,8 @@ async def monitor_speed(page, options=None):
         )
 
         if result.is_done:
+            if progress:
+                progress.finish()
             return result
 
         previous_result = result
@@ -69,15 +97,22 @@ async def monitor_speed(page, options=None):
         iteration += 1
         await asyncio.sleep(0.1)
 
-async def api(options=None):
+    raise DeadlineExceeded("fast.com did not finish the test in time", provider="fast", phase="measure")
+
+async def api(options=None, progress=None, deadline=None):
+    deadline = deadline or Deadline()
     async with async_playwright() as p:
         browser = await p.chromium.launch(args=['--no-sandbox'])
-        page = await browser.new_page()
-        await page.goto('https://fast.com')
 
         final_result = None
+        meter = NetworkMeter()
         try:
-            final_result = await monitor_speed(page, options)
+            page = await browser.new_page()
+            await meter.attach(await page.context.new_cdp_session(page))
+            with deadline.guard("fast", "load"):
+                await page.goto('https://fast.com', timeout=deadline.timeout(PAGE_TIMEOUT) * 1000)
+            with deadline.guard("fast", "measure"):
+                final_result = await monitor_speed(page, options, progress, deadline)
         finally:
             await browser.close()
 
@@ -91,9 +126,16 @@ async def api(options=None):
             clean_dict['User Location'] = final_result.__dict__['user_location']
             clean_dict['User IP'] = final_result.__dict__['user_ip']
             clean_dict['Test Complete'] = final_result.__dict__['is_done']
+            # Rates counted from the DevTools network events, to check the above
+            network = meter.report()
+            if network:
+                clean_dict['Network download speed'] = f"{network['download_mbps']} Mbps"
+                clean_dict['Network upload speed'] = f"{network['upload_mbps']} Mbps"
             print(json.dumps(clean_dict,indent=2))
-def fast_speed_test():
+            clean_dict['Network Measured'] = network
+            return clean_dict
+def fast_speed_test(progress=None, deadline=None):
     print("\n"+"Running Fast.com Speed Test (fast.com)"+"\n")
-    asyncio.run(api(Options()))
+    return asyncio.run(api(Options(), progress, deadline))
 
 #fast_speed_test()
@@ -5,21 +5,35 @@ import time
 import requests
 import websockets
 
+from .deadline import Deadline, SpeedcheckError
+from .netbind import bound_session, connect_kwargs
 
-async def download_test(uri):
-    async with websockets.connect(uri, subprotocols=['net.measurementlab.ndt.v7']) as websocket:
+# ndt7 tests run for 10 seconds and the server closes them after at most 15
+CONNECT_TIMEOUT = 10
+TEST_TIMEOUT = 30
+
+
+async def download_test(uri, progress=None, bind=None, deadline=None):
+    deadline = deadline or Deadline()
+    extra = await deadline.wait_for(connect_kwargs(uri, bind), CONNECT_TIMEOUT, "mlab", "download")
+    async with websockets.connect(uri, subprotocols=['net.measurementlab.ndt.v7'], open_timeout=deadline.timeout(CONNECT_TIMEOUT), **extra) as websocket:
+        if progress:
+            progress.phase("download")
         start = time.time() * 1000  # Start time in milliseconds
         previous = start
         total = 0
         animation = "|/-\\"
         animation_index = 0
 
-        try:
+        async def receiver():
+            nonlocal total, previous, animation_index
             while True:
                 message = await websocket.recv()
 
                 if isinstance(message, bytes):
                     total += len(message)
+                    if progress:
+                        progress.update(total)
                 elif isinstance(message, str):
                     server_message = message
                     #print(f"Server message: {server_message}")
@@ -37,8 +51,13 @@ async def download_test(uri):
                     print(f"\r{animation[animation_index % len(animation)]} Running download speed test...", end="")
                     animation_index += 1
                     previous = current_time
+
+        try:
+            await deadline.wait_for(receiver(), TEST_TIMEOUT, "mlab", "download")
         except websockets.ConnectionClosed:
             print("\nConnection closed")
+        except SpeedcheckError:
+            raise
         except Exception as e:
             print(f"\nError: {e}")
 
@@ -49,11 +68,16 @@ async def download_test(uri):
         download_dict['Mean Upload speed'] = "{:.2f} Mbps".format(mean_client_mbps)
         print("\n"+"Download test complete")
         print(json.dumps(download_dict,indent=2)+"\n")
+        return mean_client_mbps
 
 
 
-async def upload_test(uri):
-    async with websockets.connect(uri, subprotocols=['net.measurementlab.ndt.v7']) as websocket:
+async def upload_test(uri, progress=None, bind=None, deadline=None):
+    deadline = deadline or Deadline()
+    extra = await deadline.wait_for(connect_kwargs(uri, bind), CONNECT_TIMEOUT, "mlab", "upload")
+    async with websockets.connect(uri, subprotocols=['net.measurementlab.ndt.v7'], open_timeout=deadline.timeout(CONNECT_TIMEOUT), **extra) as websocket:
+        if progress:
+            progress.phase("upload")
         start = time.time() * 1000  # Start time in milliseconds
         previous = start
         total = 0
@@ -68,6 +92,8 @@ async def upload_test(uri):
             while time.time() * 1000 < end:
                 await websocket.send(data)
                 total += len(data)
+                if progress:
+                    progress.update(total)
                 current_time = time.time() * 1000
                 elapsed_time = (current_time - start) / 1000
 
@@ -78,9 +104,11 @@ async def upload_test(uri):
                     previous = current_time
 
         try:
-            await uploader()
+            await deadline.wait_for(uploader(), TEST_TIMEOUT, "mlab", "upload")
         except websockets.ConnectionClosed:
             print("\nConnection closed")
+        except SpeedcheckError:
+            raise
         except Exception as e:
             print(f"\nError: {e}")
 
@@ -91,16 +119,30 @@ async def upload_test(uri):
         upload_dict['Mean Upload speed'] = "{:.2f} Mbps".format(mean_client_mbps)
         print("\n"+"Upload test complete")
         print(json.dumps(upload_dict,indent=2))
-
-
-def get_nearest_server():
-    response = requests.get('https://locate.measurementlab.net/v2/nearest/ndt/ndt7')
-    data = response.json()
-    return data
-
-
-async def main():
-    data = get_nearest_server()
+        return mean_client_mbps
+
+
+def get_nearest_server(bind=None, deadline=None, max_retries=3):
+    deadline = deadline or Deadline()
+    session = bound_session(bind)
+    with session, deadline.guard("mlab", "locate"):
+        for attempt in range(max_retries):
+            if attempt:
+                deadline.backoff(attempt)
+            try:
+                response = session.get(
+                    'https://locate.measurementlab.net/v2/nearest/ndt/ndt7',
+                    timeout=deadline.requests_timeout((10, 15)),
+                )
+                response.raise_for_status()
+                return response.json()
+            except requests.RequestException:
+                if attempt == max_retries - 1:
+                    raise
+
+
+async def main(progress=None, bind=None, deadline=None):
+    data = get_nearest_server(bind, deadline)
 
     # Choose the first server from the list
     server = data['results'][0]
@@ -114,10 +156,17 @@ async def main():
     download_url = server['urls']['ws:///ndt/v7/download']
     upload_url = server['urls']['ws:///ndt/v7/upload']
 
-    await download_test(download_url)
-    await upload_test(upload_url)
-
-def mlab_speed_test():
-    asyncio.run(main())
+    download_mbps = await download_test(download_url, progress, bind, deadline)
+    upload_mbps = await upload_test(upload_url, progress, bind, deadline)
+    if progress:
+        progress.finish()
+    return {
+        'Server Location': ', '.join(value_store),
+        'Download Speed': "{:.2f} Mbps".format(download_mbps),
+        'Upload Speed': "{:.2f} Mbps".format(upload_mbps),
+    }
+
+def mlab_speed_test(progress=None, bind=None, deadline=None):
+    return asyncio.run(main(progress, bind, deadline))
 
 #mlab_speed_test()
@@ -2,24 +2,49 @@ import json
 
 import speedtest
 
+from .deadline import Deadline, SpeedcheckError
+from .netbind import source_address
 
-def ookla_speed_test():
+# speedtest-cli applies this to every socket it opens
+SOCKET_TIMEOUT = 10
+
+
+def ookla_speed_test(progress=None, bind=None, deadline=None):
     """
     Runs a speedtest and displays results
     """
     print("\n"+"Running Ookla Speed Test (speedtest.net)"+"\n")
+    deadline = deadline or Deadline()
+
+    if bind and bind.interface:
+        raise SpeedcheckError("unsupported", "speedtest-cli can only bind to a source address, not an interface", provider="ookla")
 
     # Create a Speedtest object
-    st = speedtest.Speedtest()
+    source = source_address(bind) if bind else None
+    with deadline.guard("ookla", "config"):
+        st = speedtest.Speedtest(
+            source_address=source[0] if source else None,
+            timeout=deadline.timeout(SOCKET_TIMEOUT),
+        )
 
-    try:
-        result_dict = {}
+    result_dict = {}
+    # speedtest-cli only exposes byte counts once a phase is complete
+    if progress:
+        progress.phase("download")
+    with deadline.guard("ookla", "download"):
         result_dict['Download Speed'] = f"{round(st.download() / 1000000,2)} Mbps"  # Convert to Mbps
+    if progress:
+        progress.update(st.results.bytes_received)
+        progress.phase("upload")
+    deadline.check("ookla", "upload")
+    with deadline.guard("ookla", "upload"):
         result_dict['Upload Speed'] = f"{round(st.upload() / 1000000,2)} Mbps"  # Convert to Mbps
-        result_dict['Server Location'] = f"{st.results.server['name']}"
-        result_dict['Ping'] = f"{st.results.ping} ms"
-        print(json.dumps(result_dict,indent=2))
-    except speedtest.SpeedtestException as e:
-        print("An error occurred during the speed test:", str(e))
+    if progress:
+        progress.update(st.results.bytes_sent)
+        progress.finish()
+    result_dict['Server Location'] = f"{st.results.server['name']}"
+    result_dict['Ping'] = f"{st.results.ping} ms"
+    print(json.dumps(result_dict,indent=2))
+    return result_dict
 
 #ookla_speed_test()
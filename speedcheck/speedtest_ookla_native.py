@@ -0,0 +1,521 @@
+import asyncio
+import datetime
+import json
+import math
+import ssl
+import time
+import xml.etree.ElementTree as ET
+from typing import NamedTuple
+from urllib.parse import urljoin, urlsplit
+
+from .deadline import Deadline, SpeedcheckError
+from .netbind import connect_kwargs
+
+CONFIG_URL = "https://www.speedtest.net/speedtest-config.php"
+SERVERS_URL = "https://www.speedtest.net/speedtest-servers-static.php"
+USER_AGENT = "Mozilla/5.0 (compatible; speedcheck) speedtest-cli/2.1.3"
+
+# Same test plan as speedtest-cli
+DOWNLOAD_SIZES = (350, 500, 750, 1000, 1500, 2000, 2500, 3000, 3500, 4000)
+UPLOAD_SIZES = (32768, 65536, 131072, 262144, 524288, 1048576, 7340032)
+RECV_BUFFER = 256 * 1024
+SEND_CHUNK = 64 * 1024
+SOCKET_TIMEOUT = 10
+CLOSEST_SERVERS = 5
+PING_COUNT = 3
+# Seconds recorded for a latency sample that failed, as in speedtest-cli
+FAILED_SAMPLE = 3600
+
+
+class OoklaConfig(NamedTuple):
+    client: dict
+    ignore_servers: tuple
+    download_streams: int
+    upload_streams: int
+    download_count: int
+    upload_count: int
+    upload_ratio: int
+    download_length: float
+    upload_length: float
+
+
+DEFAULT_CONFIG = OoklaConfig({}, (), 8, 2, 4, 8, 1, 10.0, 10.0)
+
+
+class _HTTPProtocol(asyncio.BufferedProtocol):
+    """
+    Minimal HTTP/1.1 keep-alive client for one connection. Response bodies
+    are counted straight out of the receive buffer `view`, which belongs to
+    the stream and outlives the connection, and are only copied when the
+    caller asks for the body. `on_received` and `on_sent` are called with
+    the size of every body chunk received and sent.
+    """
+
+    def __init__(self, view, on_received=None, on_sent=None):
+        self.view = view
+        self.on_received = on_received
+        self.on_sent = on_sent
+        self.transport = None
+        self.closed = False
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._reset()
+
+    def _reset(self, future=None, collect=False):
+        self.future = future
+        self.collect = collect
+        self.head = bytearray()
+        self.headers = None
+        self.status = None
+        self.body = bytearray()
+        self.remaining = None
+        self.chunked = False
+        self.received = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self._writable.set()
+        if self.future and not self.future.done():
+            if self.headers is not None and self.remaining is None and not self.chunked:
+                # Body delimited by the server closing the connection
+                self._complete()
+            else:
+                self.future.set_exception(exc or ConnectionError("Connection closed by server"))
+
+    def pause_writing(self):
+        self._writable.clear()
+
+    def resume_writing(self):
+        self._writable.set()
+
+    def get_buffer(self, sizehint):
+        return self.view
+
+    def buffer_updated(self, nbytes):
+        if self.future is None or self.future.done():
+            return
+        if self.headers is None:
+            self.head += self.view[:nbytes]
+            end = self.head.find(b"\r\n\r\n")
+            if end < 0:
+                return
+            self._parse_head(bytes(self.head[:end]))
+            body = self.head[end + 4:]
+            self.head = bytearray()
+            self._body(memoryview(body))
+        else:
+            self._body(self.view[:nbytes])
+
+    def _parse_head(self, head):
+        lines = head.decode("latin-1").split("\r\n")
+        self.status = int(lines[0].split(" ", 2)[1])
+        self.headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            self.headers[name.strip().lower()] = value.strip()
+        if self.headers.get("transfer-encoding", "").lower() == "chunked":
+            self.chunked = True
+        elif "content-length" in self.headers:
+            self.remaining = int(self.headers["content-length"])
+
+    def _body(self, data):
+        nbytes = len(data)
+        self.received += nbytes
+        if self.on_received and nbytes:
+            self.on_received(nbytes)
+        if self.collect or self.chunked:
+            self.body += data
+        if self.chunked:
+            # Chunked bodies only come from small script responses
+            if self.body.endswith(b"0\r\n\r\n"):
+                self.body = _dechunk(self.body)
+                self._complete()
+        elif self.remaining is not None:
+            self.remaining -= nbytes
+            if self.remaining <= 0:
+                self._complete()
+
+    def _complete(self):
+        future = self.future
+        result = (self.status, self.headers, bytes(self.body) if self.collect else self.received)
+        if self.headers.get("connection", "").lower() == "close":
+            self.closed = True
+            self.transport.close()
+        future.set_result(result)
+
+    async def request(self, method, target, host, body=None, collect=False):
+        if self.closed:
+            raise ConnectionError("Connection is closed")
+        future = asyncio.get_running_loop().create_future()
+        self._reset(future, collect)
+        head = [
+            f"{method} {target} HTTP/1.1",
+            f"Host: {host}",
+            f"User-Agent: {USER_AGENT}",
+            "Connection: keep-alive",
+            "Cache-Control: no-cache",
+        ]
+        if body is not None:
+            head.append(f"Content-Length: {len(body)}")
+        self.transport.write(("\r\n".join(head) + "\r\n\r\n").encode())
+        if body is not None:
+            for offset in range(0, len(body), SEND_CHUNK):
+                await self._writable.wait()
+                if self.closed:
+                    break
+                chunk = body[offset:offset + SEND_CHUNK]
+                self.transport.write(chunk)
+                if self.on_sent:
+                    self.on_sent(len(chunk))
+        return await future
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+def _dechunk(data):
+    body = bytearray()
+    view = memoryview(data)
+    pos = 0
+    while True:
+        end = data.index(b"\r\n", pos)
+        size = int(bytes(view[pos:end]).split(b";")[0], 16)
+        if size == 0:
+            return body
+        body += view[end + 2:end + 2 + size]
+        pos = end + 4 + size
+
+
+class _Stream:
+    """
+    A keep-alive connection to one host that is reopened when the server
+    closes it. The receive buffer is allocated once per stream.
+    """
+
+    def __init__(self, url, bind=None, on_received=None, on_sent=None):
+        parts = urlsplit(url)
+        self.https = parts.scheme == "https"
+        self.hostname = parts.hostname
+        self.port = parts.port or (443 if self.https else 80)
+        self.host = parts.netloc
+        self.bind = bind
+        self.on_received = on_received
+        self.on_sent = on_sent
+        self.view = memoryview(bytearray(RECV_BUFFER))
+        self.protocol = None
+
+    async def _open(self):
+        loop = asyncio.get_running_loop()
+        protocol = _HTTPProtocol(self.view, self.on_received, self.on_sent)
+        kwargs = await connect_kwargs(f"{'https' if self.https else 'http'}://{self.host}/", self.bind)
+        if self.https:
+            kwargs["ssl"] = ssl.create_default_context()
+            kwargs["server_hostname"] = self.hostname
+        if "sock" in kwargs:
+            await loop.create_connection(lambda: protocol, **kwargs)
+        else:
+            await loop.create_connection(lambda: protocol, self.hostname, self.port, **kwargs)
+        self.protocol = protocol
+
+    async def request(self, method, url, body=None, collect=False, timeout=SOCKET_TIMEOUT):
+        """
+        Send one request and return (status, headers, body or byte count).
+        `timeout` bounds the whole exchange; None leaves it to the caller.
+        """
+        parts = urlsplit(url)
+        target = parts.path + (f"?{parts.query}" if parts.query else "")
+        if self.protocol is None or self.protocol.closed:
+            await asyncio.wait_for(self._open(), SOCKET_TIMEOUT)
+        try:
+            return await asyncio.wait_for(
+                self.protocol.request(method, target or "/", self.host, body, collect), timeout
+            )
+        except BaseException:
+            # A response that was cut off leaves the connection unusable
+            self.close()
+            raise
+
+    def close(self):
+        if self.protocol is not None:
+            self.protocol.close()
+            self.protocol = None
+
+
+async def fetch(url, bind=None, redirects=3):
+    """
+    GET `url` and return the body, following redirects.
+    """
+    for _ in range(redirects + 1):
+        stream = _Stream(url, bind)
+        try:
+            status, headers, body = await stream.request("GET", url, collect=True)
+        finally:
+            stream.close()
+        if status in (301, 302, 303, 307, 308) and "location" in headers:
+            url = urljoin(url, headers["location"])
+            continue
+        if status != 200:
+            raise SpeedcheckError("http_error", f"GET {url} returned {status}", provider="ookla-native")
+        return body
+    raise SpeedcheckError("http_error", f"Too many redirects for {url}", provider="ookla-native")
+
+
+def parse_config(xml):
+    root = ET.fromstring(xml)
+    client = dict(root.find("client").attrib)
+    server_config = root.find("server-config").attrib
+    download = root.find("download").attrib
+    upload = root.find("upload").attrib
+    ratio = int(upload.get("ratio", 1))
+    upload_max = int(upload.get("maxchunkcount", 50))
+    ignore = tuple(int(i) for i in server_config.get("ignoreids", "").split(",") if i.strip())
+    return OoklaConfig(
+        client=client,
+        ignore_servers=ignore,
+        download_streams=int(server_config.get("threadcount", 4)) * 2,
+        upload_streams=int(upload.get("threads", 2)),
+        download_count=int(download.get("threadsperurl", 4)),
+        upload_count=int(math.ceil(upload_max / len(UPLOAD_SIZES[ratio - 1:]))),
+        upload_ratio=ratio,
+        download_length=float(download.get("testlength", 10)),
+        upload_length=float(upload.get("testlength", 10)),
+    )
+
+
+def _distance(origin, destination):
+    lat1, lon1 = origin
+    lat2, lon2 = destination
+    radius = 6371
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = (math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1))
+         * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2)
+    return radius * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+def parse_servers(xml, config):
+    """
+    Return the servers from the server list sorted by distance to the client.
+    """
+    origin = (float(config.client.get("lat", 0)), float(config.client.get("lon", 0)))
+    servers = []
+    for element in ET.fromstring(xml).iter("server"):
+        server = dict(element.attrib)
+        if int(server.get("id", 0)) in config.ignore_servers:
+            continue
+        server["d"] = _distance(origin, (float(server["lat"]), float(server["lon"])))
+        servers.append(server)
+    return sorted(servers, key=lambda server: server["d"])
+
+
+def _test_url(server, name):
+    return urljoin(server["url"], name)
+
+
+def _average_latency(samples):
+    # speedtest-cli 2.1.3 divides the sum of its three samples by 6, not 3,
+    # keep that so ping is comparable with the ookla provider
+    return round(sum(samples) / 6 * 1000, 3)
+
+
+async def _latency(server, bind, deadline):
+    """
+    Latency of `server` in ms measured the way speedtest-cli does: PING_COUNT
+    latency.txt GETs, each on a new connection whose connect is timed too.
+    A sample that fails or takes longer than SOCKET_TIMEOUT counts as
+    FAILED_SAMPLE, so one stalled server cannot hold up the others.
+    """
+    samples = []
+    for i in range(PING_COUNT):
+        url = _test_url(server, f"latency.txt?x={int(time.time() * 1000)}.{i}")
+        timeout = deadline.timeout(SOCKET_TIMEOUT)
+        stream = _Stream(server["url"], bind)
+        start = time.perf_counter()
+        try:
+            status, _, body = await asyncio.wait_for(stream.request("GET", url, collect=True, timeout=None), timeout)
+        except asyncio.TimeoutError:
+            deadline.check()
+            samples.append(FAILED_SAMPLE)
+            continue
+        except (OSError, ValueError):
+            samples.append(FAILED_SAMPLE)
+            continue
+        finally:
+            stream.close()
+        elapsed = time.perf_counter() - start
+        samples.append(elapsed if status == 200 and body.startswith(b"test=test") else FAILED_SAMPLE)
+    return _average_latency(samples)
+
+
+async def best_server(servers, bind=None, deadline=None):
+    deadline = deadline or Deadline()
+    latencies = await asyncio.gather(*[_latency(server, bind, deadline) for server in servers])
+    server, latency = min(zip(servers, latencies), key=lambda pair: pair[1])
+    if latency >= _average_latency([FAILED_SAMPLE] * PING_COUNT):
+        raise SpeedcheckError("connection_failed", "No test server answered the latency test", provider="ookla-native", phase="latency")
+    return dict(server, latency=latency)
+
+
+class OoklaEngine:
+    """
+    asyncio implementation of the Ookla HTTP test protocol: latency against
+    latency.txt, download of the random<N>x<N>.jpg images and POST uploads
+    to upload.php over `streams` parallel keep-alive connections.
+    """
+
+    def __init__(self, config=DEFAULT_CONFIG, streams=None, bind=None, progress=None, deadline=None):
+        self.config = config
+        self.streams = streams
+        self.bind = bind
+        self.progress = progress
+        self.deadline = deadline or Deadline()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._phase_bytes = 0
+        # Upload payload is allocated once and sliced for every request
+        largest = max(UPLOAD_SIZES)
+        self.payload = bytearray(b"content1=") + bytearray(
+            (b"0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ" * (largest // 36 + 1))[:largest - 9]
+        )
+
+    def _count(self, nbytes):
+        self._phase_bytes += nbytes
+        if self.progress:
+            self.progress.update(self._phase_bytes)
+
+    async def _run_phase(self, name, server, jobs, streams, length):
+        if self.progress:
+            self.progress.phase(name)
+        self._phase_bytes = 0
+        pending = iter(jobs)
+        errors = []
+        start = time.perf_counter()
+        stop_at = start + length
+
+        async def worker():
+            # Like speedtest-cli, only the payload direction of a phase counts
+            if name == "upload":
+                stream = _Stream(server["url"], self.bind, on_sent=self._count)
+            else:
+                stream = _Stream(server["url"], self.bind, on_received=self._count)
+            try:
+                for method, url, body in pending:
+                    # Like speedtest-cli, stop starting requests after the test length
+                    if time.perf_counter() > stop_at:
+                        break
+                    try:
+                        await stream.request(method, url, body, timeout=None)
+                    except (OSError, ValueError) as error:
+                        errors.append(error)
+                        break
+            finally:
+                stream.close()
+
+        # Requests still in flight get SOCKET_TIMEOUT after the test length
+        # to finish, then they are cancelled and count with what they moved
+        tasks = [asyncio.ensure_future(worker()) for _ in range(streams)]
+        _, unfinished = await asyncio.wait(tasks, timeout=self.deadline.timeout(length + SOCKET_TIMEOUT))
+        for task in unfinished:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        elapsed = time.perf_counter() - start
+        self.deadline.check("ookla-native", name)
+        if not self._phase_bytes:
+            # A server that accepts connections but sends nothing is not a 0 Mbps link
+            if errors:
+                with self.deadline.guard("ookla-native", name):
+                    raise errors[0]
+            raise SpeedcheckError(
+                "read_timeout", f"No data moved within {length + SOCKET_TIMEOUT:g} seconds",
+                provider="ookla-native", phase=name,
+            )
+        return self._phase_bytes, elapsed
+
+    async def download(self, server):
+        jobs = [
+            ("GET", _test_url(server, f"random{size}x{size}.jpg?x={int(time.time() * 1000)}.{i}"), None)
+            for size in DOWNLOAD_SIZES
+            for i in range(self.config.download_count)
+        ]
+        streams = self.streams or self.config.download_streams
+        received, elapsed = await self._run_phase("download", server, jobs, streams, self.config.download_length)
+        self.bytes_received += received
+        return received * 8 / elapsed
+
+    async def upload(self, server):
+        view = memoryview(self.payload)
+        sizes = UPLOAD_SIZES[self.config.upload_ratio - 1:]
+        jobs = [
+            ("POST", server["url"], view[:size])
+            for size in sizes
+            for _ in range(self.config.upload_count)
+        ]
+        streams = self.streams or self.config.upload_streams
+        sent, elapsed = await self._run_phase("upload", server, jobs, streams, self.config.upload_length)
+        self.bytes_sent += sent
+        return sent * 8 / elapsed
+
+
+async def measure(server_url=None, streams=None, bind=None, progress=None, deadline=None, config_url=CONFIG_URL, servers_url=SERVERS_URL):
+    """
+    Run a full Ookla test and return the same fields as speedtest-cli's
+    `Speedtest.results.dict()`: download and upload in bits/s, ping in ms,
+    server, timestamp, bytes_sent, bytes_received, share and client.
+
+    `server_url` skips the configuration and server list and tests against
+    that upload.php URL, for example a local stand-in server.
+    """
+    deadline = deadline or Deadline()
+    config = DEFAULT_CONFIG
+    if server_url:
+        servers = [{"url": server_url, "host": urlsplit(server_url).netloc, "d": 0.0}]
+    else:
+        with deadline.guard("ookla-native", "config"):
+            config = parse_config(await deadline.wait_for(fetch(config_url, bind), SOCKET_TIMEOUT, "ookla-native", "config"))
+            servers = parse_servers(
+                await deadline.wait_for(fetch(servers_url, bind), SOCKET_TIMEOUT, "ookla-native", "config"), config
+            )
+        if not servers:
+            raise SpeedcheckError("provider_error", "The server list is empty", provider="ookla-native", phase="config")
+
+    if progress:
+        progress.phase("latency")
+    with deadline.guard("ookla-native", "latency"):
+        server = await best_server(servers[:CLOSEST_SERVERS], bind, deadline)
+
+    engine = OoklaEngine(config, streams, bind, progress, deadline)
+    download = await engine.download(server)
+    upload = await engine.upload(server)
+    if progress:
+        progress.finish()
+
+    return {
+        "download": download,
+        "upload": upload,
+        "ping": server["latency"],
+        "server": server,
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat().replace("+00:00", "Z"),
+        "bytes_sent": engine.bytes_sent,
+        "bytes_received": engine.bytes_received,
+        "share": None,
+        "client": config.client,
+    }
+
+
+def ookla_native_speed_test(progress=None, bind=None, deadline=None, streams=None, server_url=None):
+    """
+    Runs the Ookla test with the native asyncio engine and displays results
+    """
+    print("\n"+"Running Ookla Speed Test with the native engine (speedtest.net)"+"\n")
+    results = asyncio.run(measure(server_url, streams, bind, progress, deadline))
+    result_dict = {}
+    result_dict['Download Speed'] = f"{round(results['download'] / 1000000,2)} Mbps"
+    result_dict['Upload Speed'] = f"{round(results['upload'] / 1000000,2)} Mbps"
+    result_dict['Server Location'] = f"{results['server'].get('name', results['server']['host'])}"
+    result_dict['Ping'] = f"{results['ping']} ms"
+    print(json.dumps(result_dict,indent=2))
+    return result_dict
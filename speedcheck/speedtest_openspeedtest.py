@@ -4,18 +4,35 @@ import time
 
 from playwright.sync_api import Playwright, sync_playwright
 
-
-def run(playwright: Playwright) -> None:
-    browser = playwright.chromium.launch(headless=True)
+from .cdp import NetworkMeter
+from .deadline import Deadline, DeadlineExceeded
+
+# Upper bounds for loading the page and for the whole measurement
+PAGE_TIMEOUT = 60
+TEST_TIMEOUT = 120
+
+def run(playwright: Playwright, progress=None, deadline=None, browser=None) -> dict:
+    deadline = deadline or Deadline()
+    owns_browser = browser is None
+    if owns_browser:
+        browser = playwright.chromium.launch(headless=True)
     context = browser.new_context()
     page = context.new_page()
+    meter = NetworkMeter()
+    meter.attach(context.new_cdp_session(page))
 
     try:
         # Navigate to the speed test page
-        page.goto("https://openspeedtest.com/?run")
+        with deadline.guard("openspeedtest", "load"):
+            page.goto("https://openspeedtest.com/?run", timeout=deadline.timeout(PAGE_TIMEOUT) * 1000)
+        if progress:
+            progress.phase("running")
+            meter.follow(progress)
 
         # Wait for the page to navigate to the results page
-        page.wait_for_url(re.compile(r"https://openspeedtest.com/results/.*"), timeout=60000)
+        test_deadline = deadline.sub(TEST_TIMEOUT)
+        with deadline.guard("openspeedtest", "measure"):
+            page.wait_for_url(re.compile(r"https://openspeedtest.com/results/.*"), timeout=test_deadline.timeout(TEST_TIMEOUT) * 1000)
 
         # Initialize results dictionary
         results_dict = {}
@@ -25,10 +42,16 @@ def run(playwright: Playwright) -> None:
 
         # Animation loop while waiting for results
         while not page.locator('symbol#downResultC1 text.rtextnum').first.is_visible():
+            if test_deadline.expired:
+                raise DeadlineExceeded("openspeedtest.com did not show results in time", provider="openspeedtest", phase="measure")
             print(f"{animation[animation_index]} Running speed test...", end="\r")
             animation_index = (animation_index + 1) % len(animation)
             time.sleep(0.1)
 
+        if progress:
+            meter.follow(None)
+            progress.finish()
+
         # Extract download speed
         download_element = page.locator('symbol#downResultC1 text.rtextnum')
         download_speed = download_element.evaluate('(element) => element.textContent')
@@ -59,22 +82,33 @@ def run(playwright: Playwright) -> None:
         server_name = server_name_element.evaluate('(element) => element.textContent.trim()')
         results_dict['Server Name'] = server_name
 
+        # Rates counted from the DevTools network events, to check the above
+        network = meter.report()
+        if network:
+            results_dict['Network Download Speed'] = f"{network['download_mbps']} Mbps"
+            results_dict['Network Upload Speed'] = f"{network['upload_mbps']} Mbps"
+
         # Print results as JSON
         print(json.dumps(results_dict, indent=2))
+        results_dict['Network Measured'] = network
+        return results_dict
 
     finally:
         # Close the browser
         context.close()
-        browser.close()
+        if owns_browser:
+            browser.close()
 
-def openspeedtest_speed_test():
+def openspeedtest_speed_test(progress=None, deadline=None, browser=None):
     """
     This function runs a speed test on openspeedtest.com using the Playwright library.
     It navigates to the website, starts the test, waits for completion, extracts the speed, ping, jitter, ISP, and server information,
     and prints the results in JSON format.
     """
     print("\nRunning Open Speed Test (openspeedtest.com)"+"\n")
+    if browser is not None:
+        return run(None, progress, deadline, browser)
     with sync_playwright() as playwright:
-        run(playwright)
+        return run(playwright, progress, deadline)
 
 #ost_test()
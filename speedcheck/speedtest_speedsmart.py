@@ -3,9 +3,14 @@ import time
 
 from playwright.sync_api import Playwright, sync_playwright
 
-result_dict = {}
+from .cdp import NetworkMeter
+from .deadline import Deadline, DeadlineExceeded
 
-def run(playwright: Playwright) -> None:
+# Upper bounds for loading the page and for the whole measurement
+PAGE_TIMEOUT = 60
+TEST_TIMEOUT = 120
+
+def run(playwright: Playwright, progress=None, deadline=None, browser=None) -> dict:
     """
     This function runs a speed test on speedsmart.net using the Playwright library.
     It navigates to the website, starts the test, waits for completion, extracts the speed, ping, jitter, ISP, and server information,
@@ -13,29 +18,50 @@ def run(playwright: Playwright) -> None:
 
     Parameters:
     playwright (Playwright): An instance of the Playwright library.
+    progress (ProgressReporter, optional): Receives phase start and end events.
+    deadline (Deadline, optional): Overall time budget for the run.
+    browser (Browser, optional): An already launched browser to reuse, it is left open.
 
     Returns:
-    None
+    dict: The extracted results.
     """
-    browser = playwright.chromium.launch(headless=True)
+    deadline = deadline or Deadline()
+    # Per run, so runs in one long-lived process do not share results
+    result_dict = {}
+    owns_browser = browser is None
+    if owns_browser:
+        browser = playwright.chromium.launch(headless=True)
     context = browser.new_context()
     page = context.new_page()
+    meter = NetworkMeter()
+    meter.attach(context.new_cdp_session(page))
 
     try:
         # Navigate to the page
-        page.goto("https://speedsmart.net/", timeout=60000)
+        with deadline.guard("speedsmart", "load"):
+            page.goto("https://speedsmart.net/", timeout=deadline.timeout(PAGE_TIMEOUT) * 1000)
 
-        # Click the "Start Test" button
-        page.locator('button.button_start#start_button').click()
+            # Click the "Start Test" button
+            page.locator('button.button_start#start_button').click(timeout=deadline.timeout(PAGE_TIMEOUT) * 1000)
+        if progress:
+            progress.phase("running")
+            meter.follow(progress)
 
         # Print animation while waiting for test completion
         animation = "|/-\\"
         animation_index = 0
+        test_deadline = deadline.sub(TEST_TIMEOUT)
         while not page.locator('#restart_button').is_visible():
+            if test_deadline.expired:
+                raise DeadlineExceeded("speedsmart.net did not finish the test in time", provider="speedsmart", phase="measure")
             print(f"{animation[animation_index]} Running speed test...", end="\r")
             animation_index = (animation_index + 1) % len(animation)
             time.sleep(0.1)
 
+        if progress:
+            meter.follow(None)
+            progress.finish()
+
         # Extract values after the test completes
         print("\n"+"Test completed!"+"\n")
         result_dict['download_speed'] = float(page.locator('#finished_download').inner_text())
@@ -45,21 +71,31 @@ def run(playwright: Playwright) -> None:
         result_dict['isp_name'] = page.locator('#current_isp_name_hover').inner_text()
         result_dict['server_name'] = page.locator('#current_server_name_hover').inner_text()
 
+        # Rates counted from the DevTools network events, to check the above
+        network = meter.report()
+        if network:
+            result_dict['network_download_speed'] = network['download_mbps']
+            result_dict['network_upload_speed'] = network['upload_mbps']
 
     finally:
         context.close()
-        browser.close()
+        if owns_browser:
+            browser.close()
 
         json_result = json.dumps(result_dict, indent=2)
         print(json_result)
-def speedsmart_speed_test():
+    result_dict['Network Measured'] = network
+    return result_dict
+def speedsmart_speed_test(progress=None, deadline=None, browser=None):
     """
     This function runs a speed test on speedsmart.net using the Playwright library.
     It navigates to the website, starts the test, waits for completion, extracts the speed, ping, jitter, ISP, and server information,
     and prints the results in JSON format.
     """
     print("\nRunning SpeedSmart.net Speed Test (speedsmart.net)"+"\n")
+    if browser is not None:
+        return run(None, progress, deadline, browser)
     with sync_playwright() as playwright:
-        run(playwright)
+        return run(playwright, progress, deadline)
 
 #speedsmart_test()
@@ -0,0 +1,47 @@
+import math
+import re
+
+# Result keys used by the different providers for the same measurement
+_KEYS = {
+    "download_mbps": ("Download Speed", "Download speed", "download_speed"),
+    "upload_mbps": ("Upload Speed", "Upload speed", "upload_speed"),
+    "latency_ms": ("Latency", "Ping", "ping_speed"),
+    "jitter_ms": ("Jitter", "jitter"),
+}
+
+_RATE_UNITS = {"bps": 1e-6, "kbps": 1e-3, "mbps": 1.0, "gbps": 1e3}
+
+_NUMBER = re.compile(r"^\s*(-?[0-9.]+)\s*([A-Za-z]*)")
+
+
+def to_number(value, rate=False):
+    """
+    Convert a provider value such as "93.4 Mbps", "12 ms" or 93.4 to a
+    float. Rates are normalised to Mbps. Returns None when there is no value.
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return None if math.isnan(value) else float(value)
+    match = _NUMBER.match(str(value))
+    if not match:
+        return None
+    number = float(match.group(1))
+    if rate and match.group(2):
+        number *= _RATE_UNITS.get(match.group(2).lower(), 1.0)
+    return number
+
+
+def summarize(result: dict) -> dict:
+    """
+    Pull the numeric download, upload, latency and jitter out of a provider
+    result dict.
+    """
+    summary = {}
+    for name, keys in _KEYS.items():
+        summary[name] = None
+        for key in keys:
+            if key in result:
+                summary[name] = to_number(result[key], rate=name.endswith("_mbps"))
+                break
+    return summary
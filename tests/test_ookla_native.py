@@ -0,0 +1,112 @@
+import asyncio
+import re
+import socket
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from speedcheck import speedtest_ookla_native as native
+from speedcheck.deadline import SpeedcheckError
+
+
+def _image_size(path):
+    # The stand-in sends 10 bytes per pixel row instead of a real image
+    return int(re.search(r"random(\d+)x", path).group(1)) * 10
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """Local stand-in for an Ookla test server."""
+
+    protocol_version = "HTTP/1.1"
+    stall = False
+    uploaded = 0
+
+    def _reply(self, body):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith("/speedtest/latency.txt"):
+            self._reply(b"test=test\n")
+        elif self.stall:
+            time.sleep(3)
+        else:
+            self._reply(b"x" * _image_size(self.path))
+
+    def do_POST(self):
+        size = int(self.headers["Content-Length"])
+        self.rfile.read(size)
+        type(self).uploaded += size
+        self._reply(f"size={size}".encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class OoklaNativeTest(unittest.TestCase):
+    def setUp(self):
+        StandIn.stall = False
+        StandIn.uploaded = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/speedtest/upload.php"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_measure_reports_speedtest_cli_fields(self):
+        result = asyncio.run(native.measure(self.url, streams=2))
+
+        config = native.DEFAULT_CONFIG
+        expected_received = sum(
+            _image_size(f"random{size}x{size}.jpg") * config.download_count for size in native.DOWNLOAD_SIZES
+        )
+        expected_sent = sum(native.UPLOAD_SIZES) * config.upload_count
+        self.assertEqual(result["bytes_received"], expected_received)
+        self.assertEqual(result["bytes_sent"], expected_sent)
+        self.assertEqual(StandIn.uploaded, expected_sent)
+        self.assertGreater(result["download"], 0)
+        self.assertGreater(result["upload"], 0)
+        self.assertGreater(result["ping"], 0)
+        self.assertEqual(result["server"]["url"], self.url)
+        self.assertEqual(
+            set(result),
+            {"download", "upload", "ping", "server", "timestamp", "bytes_sent", "bytes_received", "share", "client"},
+        )
+
+    def test_stalled_download_is_an_error(self):
+        StandIn.stall = True
+        config = native.DEFAULT_CONFIG._replace(download_length=0.2)
+        with mock.patch.object(native, "DEFAULT_CONFIG", config), mock.patch.object(native, "SOCKET_TIMEOUT", 0.5):
+            with self.assertRaises(SpeedcheckError) as raised:
+                asyncio.run(native.measure(self.url, streams=2))
+        self.assertEqual(raised.exception.reason, "read_timeout")
+        self.assertEqual(raised.exception.phase, "download")
+
+    def test_stalled_server_loses_the_latency_test(self):
+        # Accepts connections through its backlog but never answers
+        stalled = socket.socket()
+        stalled.bind(("127.0.0.1", 0))
+        stalled.listen()
+        self.addCleanup(stalled.close)
+        servers = [
+            {"url": f"http://127.0.0.1:{stalled.getsockname()[1]}/speedtest/upload.php"},
+            {"url": self.url},
+        ]
+        with mock.patch.object(native, "SOCKET_TIMEOUT", 0.3), \
+                mock.patch.object(native, "fetch", mock.AsyncMock(return_value=b"")), \
+                mock.patch.object(native, "parse_config", return_value=native.DEFAULT_CONFIG), \
+                mock.patch.object(native, "parse_servers", return_value=servers):
+            result = asyncio.run(native.measure(streams=2))
+        self.assertEqual(result["server"]["url"], self.url)
+        self.assertLess(result["ping"], native._average_latency([native.FAILED_SAMPLE] * native.PING_COUNT))
+
+
+if __name__ == "__main__":
+    unittest.main()